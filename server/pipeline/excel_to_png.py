@@ -9,13 +9,27 @@ playwright_path = os.path.join(workspace_dir, '.cache', 'ms-playwright')
 os.environ['PLAYWRIGHT_BROWSERS_PATH'] = playwright_path
 print(f"[Pipeline] Set PLAYWRIGHT_BROWSERS_PATH to: {playwright_path}", file=sys.stderr)
 
+import argparse
+import datetime
+import functools
+import hashlib
+import io
 import json
 import pandas as pd
+import openpyxl
+import xlrd
 from jinja2 import Environment, FileSystemLoader
 from playwright.sync_api import sync_playwright
+import itertools
 import math
+import queue
 import shutil
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageFilter, ImageStat
 import re
 import warnings
 
@@ -42,6 +56,134 @@ GRID_ROWS = 3
 COVER_BLUR_RADIUS = 8
 FREE_PREVIEW_IMAGES = 10
 
+# Number of browsers rendering pages in parallel (one Chromium process each)
+RENDER_WORKERS = 1
+
+# Threads that blur, watermark and encode captured pages while the browsers capture the next
+# ones, and how many captured pages may wait for them before the browsers pause
+POST_WORKERS = 2
+POST_QUEUE_SIZE = 8
+
+# "navigate": load every page as its own document
+# "template": load template.html once per browser page and only update the cells
+RENDER_MODES = ("navigate", "template")
+RENDER_MODE = "navigate"
+
+# "chromium": screenshot template.html in a browser
+# "pillow": draw the same table directly with Pillow (no browser needed)
+RENDER_ENGINES = ("chromium", "pillow")
+RENDER_ENGINE = "chromium"
+
+# full: blurred pages are rendered like clear ones and blurred at full size
+# downscaled: blurred pages are drawn with Pillow at BLURRED_PAGE_SCALE, blurred there and upscaled
+# (drawn BLURRED_PAGE_SUPERSAMPLE times larger and box-reduced, so small text keeps its weight)
+BLURRED_PAGE_MODES = ("full", "downscaled")
+BLURRED_PAGE_MODE = "full"
+BLURRED_PAGE_SCALE = 0.25
+BLURRED_PAGE_SUPERSAMPLE = 2
+
+# Output encoders: name -> (Pillow format, file extension)
+# png: lossless at PNG_COMPRESS_LEVEL (zlib 0-9); webp: lossless WebP
+# webp-lossy and jpeg: lossy at IMAGE_QUALITY (1-100)
+IMAGE_FORMATS = {
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "webp-lossy": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+IMAGE_FORMAT = "png"
+IMAGE_QUALITY = 80
+PNG_COMPRESS_LEVEL = 6
+WEBP_METHOD = 4
+
+# Palette quantization of PNG pages (0 keeps full RGB). A run builds one palette from a
+# sample page up front and pages reuse it when it fits them (RMS error per channel at most
+# PALETTE_MAX_ERROR); a page it does not fit gets an adaptive palette of its own.
+PALETTE_COLORS = 0
+PALETTE_MAX_ERROR = 2.0
+
+# Finished pages by content hash (see PageCache) and whole results by workbook fingerprint
+# (see ResultCache); bump the version when rendering or masking changes
+PAGE_CACHE_VERSION = 3
+
+# Pages finished in an output directory, one JSON line each, for --resume (see ProgressManifest)
+PROGRESS_MANIFEST = "pipeline_progress.jsonl"
+
+# Upload stage (--upload-to): s3://bucket/prefix or file:///directory. S3 credentials and
+# endpoint come from the same environment variables as server/services/doSpaces.ts.
+UPLOAD_SCHEMES = ("s3", "file")
+UPLOAD_WORKERS = 8
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY = 0.5
+UPLOAD_REGION = "sgp1"
+UPLOAD_DEFAULT_ENDPOINT = "https://sgp1.digitaloceanspaces.com"
+UPLOAD_CONTENT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+# Pillow engine layout, mirroring template.html as Chromium renders it
+TABLE_MARGIN = 8
+TABLE_CELL_PADDING_X = 2
+TABLE_CELL_PADDING_Y = 1
+TABLE_FONT_SIZE = 20
+TABLE_TEXT_COLOR = (0, 0, 0)
+TABLE_BORDER_COLOR = (176, 176, 176)
+TABLE_FONT_PATHS = [
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+]
+_table_font_cache = threading.local()
+
+# Watermark layers by image size (see get_watermark_overlay)
+_watermark_overlay_cache = {}
+_watermark_overlay_lock = threading.Lock()
+
+# Compiled templates by (path, mtime), so a long-lived worker (--serve) loads each once
+_template_cache = {}
+
+# Job fields a --serve request may set in addition to the three paths
+SERVE_JOB_OPTIONS = ("stream", "render_workers", "in_memory", "render_mode", "engine", "part_size",
+                     "sheet_names", "start_row", "end_row", "preview_first", "blurred_pages",
+                     "post_workers", "image_format", "image_quality", "compress_level",
+                     "palette_colors", "page_cache", "result_cache", "resume", "progress",
+                     "upload_to", "upload_workers")
+
+# Fills the loaded template skeleton with one page: column widths, row numbers,
+# cell classes and values. Values go through innerHTML, like the unescaped
+# {{ cell.value }} in template.html.
+UPDATE_CELLS_JS = """
+(data) => {
+    document.title = data.title;
+    const cols = document.querySelectorAll('colgroup col');
+    data.column_widths.forEach((width, i) => { cols[i].style.width = width + 'px'; });
+    const rows = document.querySelectorAll('tbody tr');
+    data.page_data.forEach((row, r) => {
+        const cells = rows[r].cells;
+        cells[0].innerHTML = row.excel_row_num;
+        row.cells.forEach((cell, c) => {
+            cells[c + 1].className = cell.class;
+            cells[c + 1].innerHTML = cell.value;
+        });
+    });
+}
+"""
+BROWSER_LAUNCH_ARGS = [
+    "--no-sandbox", 
+    "--disable-setuid-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--single-process"
+]
+
+# Streaming mode keeps at most this many pages of rows in memory per sheet
+STREAM_WINDOW_PAGES = 50
+STREAM_EXTENSIONS = (".xlsx", ".xlsm", ".xls")
+
+# Strings pandas.read_excel treats as missing; streamed cells must match
+STREAM_NA_VALUES = frozenset([
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None",
+    "n/a", "nan", "null"
+])
+
 KEYWORDS_TO_MASK = [
     "trangvang", 
     "scribd", 
@@ -54,6 +196,16 @@ KEYWORDS_TO_MASK = [
     "google.com/maps/"
 ]
 
+# Masking patterns, compiled once. Keywords are masked one after another (an
+# earlier keyword can hide a later one, e.g. "thue" inside "masothue"), so the
+# combined pattern is only used to skip cells that contain none of them.
+MASK_URL_PATTERN = re.compile(r'\b(?:https?://|www\.)\S+\b')
+MASK_KEYWORD_PATTERNS = [re.compile(re.escape(keyword), re.IGNORECASE) for keyword in KEYWORDS_TO_MASK]
+MASK_KEYWORD_ANY_PATTERN = re.compile("|".join(re.escape(keyword) for keyword in KEYWORDS_TO_MASK), re.IGNORECASE)
+MASK_EMAIL_PATTERN = re.compile(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b')
+MASK_DIGITS_PATTERN = re.compile(r'\d+')
+STRICT_DIGIT_PATTERN = re.compile(r'\d')
+
 # Keywords that trigger complete cell content removal (case-insensitive)
 KEYWORDS_TO_REMOVE_CELL = [
     "trang vang",
@@ -67,8 +219,20 @@ KEYWORDS_TO_REMOVE_CELL = [
     "google.com/map"
 ]
 
+# Distinct cell strings remembered by each cell cache (keyword removal, masking)
+CELL_CACHE_SIZE = 65536
+
+REMOVE_CELL_ANY_PATTERN = re.compile("|".join(re.escape(keyword.lower()) for keyword in KEYWORDS_TO_REMOVE_CELL))
+
+# Leak scan on masked cell values: emails and 7+ digit numbers that survived masking
+LEAK_EMAIL_PATTERN = re.compile(r'\b[a-zA-Z0-9][a-zA-Z0-9._%+-]*@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b')
+LEAK_NUMBER_PATTERN = re.compile(r'(?<!\*)\b\d{7,}\b')
+LEAK_ANY_PATTERN = re.compile(r'@|\d{7}')
+LEAK_LOG_LIMIT = 20
+
 # Facebook URL to check in first 30 rows - if found, delete all rows from that row to row 1
 FACEBOOK_URL_TO_CHECK = "https://www.facebook.com/datakhachhangtiemnang1"
+FACEBOOK_URL_SCAN_ROWS = 30
 
 def remove_header_rows_with_facebook_url(df):
     """
@@ -76,7 +240,7 @@ def remove_header_rows_with_facebook_url(df):
     If found, delete all rows from that row back to row 1 (inclusive).
     Returns the cleaned DataFrame.
     """
-    max_rows_to_check = min(30, len(df))
+    max_rows_to_check = min(FACEBOOK_URL_SCAN_ROWS, len(df))
     
     for row_idx in range(max_rows_to_check):
         for col_idx in range(len(df.columns)):
@@ -137,27 +301,77 @@ def clean_dataframe_cells(df):
     """
     Pre-process DataFrame to remove cell contents that contain restricted keywords.
     This must be called BEFORE HTML generation.
+    Same rule as should_remove_cell_content, applied a whole column at a time; every
+    column then has its dtype inferred again from its values, as df.map would.
     Returns the cleaned DataFrame.
     """
     cleaned_count = 0
+    cleaned_df = df.copy()
     
-    def clean_cell(value):
-        nonlocal cleaned_count
-        if should_remove_cell_content(value):
-            cleaned_count += 1
-            return ""
-        return value
-    
-    try:
-        cleaned_df = df.map(clean_cell)
-    except AttributeError:
-        cleaned_df = df.applymap(clean_cell)
+    for col in df.columns:
+        column = df[col]
+        hits = _remove_cell_cache.map(stringify_column(column)).astype(bool)
+        hit_count = int(hits.sum())
+        if hit_count:
+            cleaned_count += hit_count
+            column = column.astype(object).where(~hits, "")
+        cleaned_df[col] = column.infer_objects()
     
     if cleaned_count > 0:
         log(f"[Cleanup] Removed content from {cleaned_count} cells containing restricted keywords")
     
     return cleaned_df
 
+def stringify_column(column):
+    """str() of every cell of a column, as an object Series (so .str uses Python's re)."""
+    return column.astype(object).map(str).astype(object)
+
+def stringify_cells(df):
+    """
+    str() of every cell, exactly as iterrows() would hand the cells out: rows are
+    taken from df.to_numpy(), so all-numeric frames are upcast the same way. The
+    values are kept as they are (dtype=object), never re-inferred as dates.
+    """
+    common = pd.DataFrame(df.to_numpy(), index=df.index, columns=df.columns, dtype=object)
+    return pd.DataFrame({col: stringify_column(common[col]) for col in common.columns}, index=df.index)
+
+def remove_cell_texts(texts):
+    """should_remove_cell_content over a Series of distinct str(cell) values."""
+    return texts.str.lower().str.contains(REMOVE_CELL_ANY_PATTERN)
+
+def mask_cell_texts(texts):
+    """
+    mask_cell_value over a Series of distinct str(cell) values: the same passes in
+    the same order, applied through .str to the values that can match.
+    """
+    texts = texts.copy()
+    blank = texts.str.strip().str.lower().eq('nan') | texts.eq('')
+
+    has_url = texts.str.contains('://', regex=False) | texts.str.contains('www.', regex=False)
+    if has_url.any():
+        texts[has_url] = texts[has_url].str.replace(MASK_URL_PATTERN, mask_all_chars, regex=True)
+
+    has_keyword = texts.str.contains(MASK_KEYWORD_ANY_PATTERN)
+    if has_keyword.any():
+        for pattern in MASK_KEYWORD_PATTERNS:
+            texts[has_keyword] = texts[has_keyword].str.replace(pattern, mask_all_chars, regex=True)
+
+    has_email = texts.str.contains('@', regex=False)
+    if has_email.any():
+        texts[has_email] = texts[has_email].str.replace(MASK_EMAIL_PATTERN, mask_email_group, regex=True)
+
+    texts = texts.str.replace(MASK_DIGITS_PATTERN, mask_number_group, regex=True)
+    texts[blank] = ""
+    return texts
+
+def mask_cell_value_strict(value):
+    """
+    Stricter profile for cells that still leak after mask_cell_value:
+    every email is masked in full and every digit is masked.
+    """
+    text = MASK_EMAIL_PATTERN.sub(mask_all_chars, str(value))
+    return STRICT_DIGIT_PATTERN.sub('*', text)
+
 def mask_cell_value(value):
     """
     Hàm mã hóa trung tâm.
@@ -167,56 +381,162 @@ def mask_cell_value(value):
     if not text or text.strip().lower() == 'nan':
         return ""
     
-    url_pattern = r'\b(?:https?://|www\.)\S+\b'
-    text = re.sub(url_pattern, mask_all_chars, text)
+    # Each pass only runs when a cheap check says it can match; the passes and
+    # their order are unchanged, so the output is identical to running them all.
+    if '://' in text or 'www.' in text:
+        text = MASK_URL_PATTERN.sub(mask_all_chars, text)
 
-    for keyword in KEYWORDS_TO_MASK:
-        pattern = re.compile(re.escape(keyword), re.IGNORECASE)
-        text = pattern.sub(mask_all_chars, text)
+    if MASK_KEYWORD_ANY_PATTERN.search(text):
+        for pattern in MASK_KEYWORD_PATTERNS:
+            text = pattern.sub(mask_all_chars, text)
 
-    email_pattern = r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b'
-    text = re.sub(email_pattern, mask_email_group, text)
+    if '@' in text:
+        text = MASK_EMAIL_PATTERN.sub(mask_email_group, text)
 
-    text = re.sub(r'\d+', mask_number_group, text)
-    
-    return text
+    return MASK_DIGITS_PATTERN.sub(mask_number_group, text)
 
-def check_html_leakage_count(html_path, file_name_check):
-    leak_count = 0
-    details = []
-    try:
-        with open(html_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        email_pattern = r'\b[a-zA-Z0-9][a-zA-Z0-9._%+-]*@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b'
-        leaked_emails = re.findall(email_pattern, content)
-        if leaked_emails:
-            leak_count += len(leaked_emails)
-            details.extend(leaked_emails)
-
-        number_pattern = r'(?<!\*)\b\d{7,}\b'
-        leaked_numbers = re.findall(number_pattern, content)
-        if leaked_numbers:
-            for num in leaked_numbers:
-                if num in file_name_check:
-                    continue
-                leak_count += 1
-                details.append(num)
-            
-        return leak_count, details
-    except Exception as e:
-        return 1, [f"Error reading file: {e}"]
+class CellValueCache:
+    """
+    Bounded LRU memo for a per-cell function, keyed by the raw cell string (str(cell)).
+    compute is the per-value function; compute_many takes a Series of strings, so the
+    misses of a whole column are computed together.
+    """
 
-def get_column_widths(df_chunk):
-    if df_chunk.empty:
-        return []
-    try:
-        avg_lengths = df_chunk.astype(str).map(lambda x: len(str(x).strip())).mean()
-    except AttributeError:
-        avg_lengths = df_chunk.astype(str).applymap(lambda x: len(str(x).strip())).mean()
+    def __init__(self, compute, compute_many, maxsize=CELL_CACHE_SIZE):
+        self.compute = compute
+        self.compute_many = compute_many
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, result):
+        self.entries[key] = result
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __call__(self, value):
+        key = str(value)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        result = self.compute(key)
+        self._store(key, result)
+        return result
+
+    def map(self, strings):
+        """Look up a Series of str(cell) values; repeats within it count as hits."""
+        codes, uniques = pd.factorize(strings)
+        results = [None] * len(uniques)
+        missing = []
+        for position, key in enumerate(uniques):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                results[position] = self.entries[key]
+            else:
+                missing.append(position)
+        if missing:
+            computed = self.compute_many(pd.Series([uniques[position] for position in missing], dtype=object))
+            for position, result in zip(missing, computed.tolist()):
+                results[position] = result
+                self._store(uniques[position], result)
+        self.misses += len(missing)
+        self.hits += len(strings) - len(missing)
+        return pd.Series(pd.Series(results, dtype=object).to_numpy()[codes], index=strings.index, dtype=object)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+_remove_cell_cache = CellValueCache(should_remove_cell_content, remove_cell_texts)
+_mask_cell_cache = CellValueCache(mask_cell_value, mask_cell_texts)
+
+def find_cell_leaks(value, file_name_check):
+    """Emails and 7+ digit numbers still visible in a masked cell value (numbers that are part of the file name are allowed)."""
+    leaks = LEAK_EMAIL_PATTERN.findall(value)
+    leaks.extend(num for num in LEAK_NUMBER_PATTERN.findall(value) if num not in file_name_check)
+    return leaks
+
+def describe_cell_leaks(value, sheet_name, excel_row_num, c_idx, file_name_check):
+    """find_cell_leaks with each leak attributed to its sheet, Excel row and column letter."""
+    return [
+        {"sheet": sheet_name, "row": excel_row_num, "column": openpyxl.utils.get_column_letter(c_idx + 1), "value": leaked}
+        for leaked in find_cell_leaks(value, file_name_check)
+    ]
+
+def find_sheet_leaks(masked, sheet_name, file_name_check):
+    """Scan the masked cells of a sheet for leaks. Returns {row label: [leak, ...]}."""
+    leaks_by_row = {}
+    for c_idx, col in enumerate(masked.columns):
+        suspects = masked[col][masked[col].str.contains(LEAK_ANY_PATTERN)]
+        for r_idx, value in suspects.items():
+            leaks = describe_cell_leaks(value, sheet_name, int(r_idx) + 1, c_idx, file_name_check)
+            if leaks:
+                leaks_by_row.setdefault(r_idx, []).extend(leaks)
+    return leaks_by_row
+
+def remask_page_strict(html_page, template, file_name_check):
+    """
+    Re-mask only the leaking cells of a page with mask_cell_value_strict, re-check those
+    cells and re-render the page's HTML (if it has any). Updates the record in place.
+    """
+    leaking_cells = {(leak["row"], leak["column"]) for leak in html_page["leaks"]}
+    col_widths = html_page["column_widths"]
+    leaks = []
+    for row in html_page["page_data"]:
+        for c_idx, cell in enumerate(row["cells"]):
+            if (row["excel_row_num"], openpyxl.utils.get_column_letter(c_idx + 1)) not in leaking_cells:
+                continue
+            value = mask_cell_value_strict(cell["value"])
+            row["cells"][c_idx] = {"value": value, "class": get_cell_class(value, col_widths[c_idx+1])}
+            leaks.extend(describe_cell_leaks(value, html_page["sheet"], row["excel_row_num"], c_idx, file_name_check))
+    html_page["leaks"] = leaks
+    html_page["content_key"] = page_content_key(col_widths, html_page["page_data"])
+
+    if html_page["html"] is None and html_page["html_path"] is None:
+        return
+    page_html = template.render({"title": html_page["title"], "page_data": html_page["page_data"], "column_widths": col_widths})
+    if html_page["html_path"] is not None:
+        with open(html_page["html_path"], 'w', encoding='utf-8') as f:
+            f.write(page_html)
+    else:
+        html_page["html"] = page_html
+
+def count_page_leaks(pages):
+    """Total leak count and the attributed leaks of a list of page records."""
+    details = [leak for page in pages for leak in page["leaks"]]
+    return len(details), details
+
+def get_cell_lengths(df):
+    """Per-cell text lengths (stripped str of each cell) for the column width rule, computed for a whole sheet at once."""
+    return pd.DataFrame(
+        {col: stringify_column(df[col].astype(str)).str.strip().str.len() for col in df.columns},
+        index=df.index
+    )
+
+def get_page_column_widths(page_lengths):
+    """Column widths of one page from its slice of get_cell_lengths: the three longest columns on average are wide (placeholder columns count as empty)."""
+    avg_lengths = page_lengths.mean()
+    placeholders = [f'ph_{i}' for i in range(len(avg_lengths), DATA_COLS_TO_KEEP)]
+    if placeholders:
+        avg_lengths = pd.concat([avg_lengths, pd.Series(0.0, index=placeholders)])
+    return get_column_widths_from_averages(avg_lengths)
+
+def get_column_widths_from_averages(avg_lengths):
     top_3_indices = avg_lengths.sort_values(ascending=False).head(3).index
     data_widths = []
-    for i in range(len(df_chunk.columns)):
+    for i in range(len(avg_lengths)):
         if i in top_3_indices:
             data_widths.append(TOP_3_COL_WIDTH)
         else:
@@ -231,42 +551,325 @@ def get_cell_class(text, col_width):
     estimated_height = num_lines * LINE_HEIGHT_ESTIMATE
     return "wrap-text" if estimated_height <= ROW_HEIGHT else "no-wrap-text"
 
-def generate_html_for_sheet(df, file_name, sheet_name, template, html_dir):
+def generate_html_for_sheet(df, file_name, sheet_name, template, html_dir, first_page=1, keep_page_data=False, render_html=True):
+    """
+    Render one HTML document per page of the sheet and return the page records.
+    Pages are written to html_dir, or kept in the record ("html") when html_dir is None.
+    keep_page_data also stores the template context (title, column_widths, page_data)
+    for renderers that fill the cells themselves; those can skip the HTML (render_html=False).
+    With an html_dir the context goes to a JSON file there too ("context_path", read back
+    by load_page_context), so a streamed sheet does not keep every page's cells in memory.
+    Every record lists the leaks found in its masked cells ("leaks"); pages with leaks
+    always keep their template context in the record so they can be re-masked. "content_key" hashes
+    what the page shows (page_content_key), for the page cache and the progress manifest.
+    """
     generated_files = []
     
     if len(df.columns) > DATA_COLS_TO_KEEP:
         df = df.iloc[:, :DATA_COLS_TO_KEEP]
-    df = df[df.apply(lambda row: any(str(cell).strip() != '' and str(cell).strip().lower() != 'nan' for cell in row), axis=1)]
+    # Stringify, filter and mask column by column for the whole sheet, then slice pages.
+    cells = stringify_cells(df)
+    stripped = cells.apply(lambda column: column.str.strip())
+    keep = (stripped.ne('') & stripped.apply(lambda column: column.str.lower()).ne('nan')).any(axis=1)
+    df, cells = df[keep], cells[keep]
     if df.empty:
         return []
+    masked = pd.DataFrame({col: _mask_cell_cache.map(cells[col]) for col in cells.columns}, index=cells.index)
+    leaks_by_row = find_sheet_leaks(masked, sheet_name, file_name)
+    lengths = get_cell_lengths(df)
 
     num_pages = math.ceil(len(df) / ROWS_PER_PAGE)
-    for i in range(num_pages):
-        page_df = df.iloc[i*ROWS_PER_PAGE : (i+1)*ROWS_PER_PAGE]
-        temp_df = page_df.copy()
-        while len(temp_df.columns) < DATA_COLS_TO_KEEP:
-            temp_df[f'ph_{len(temp_df.columns)}'] = ''
-        col_widths = get_column_widths(temp_df)
+    for page_offset in range(num_pages):
+        page_rows = slice(page_offset*ROWS_PER_PAGE, (page_offset+1)*ROWS_PER_PAGE)
+        i = first_page + page_offset - 1
+        col_widths = get_page_column_widths(lengths.iloc[page_rows])
 
         page_data = []
-        for r_idx, row in page_df.iterrows():
-            row_cells = []
-            for c_idx, cell in enumerate(row):
-                val = mask_cell_value('' if str(cell).strip().lower() == 'nan' else cell)
-                row_cells.append({"value": val, "class": get_cell_class(val, col_widths[c_idx+1])})
+        page_leaks = []
+        page_masked = masked.iloc[page_rows]
+        for r_idx, row in zip(page_masked.index, page_masked.to_numpy().tolist()):
+            page_leaks.extend(leaks_by_row.get(r_idx, []))
+            row_cells = [{"value": val, "class": get_cell_class(val, col_widths[c_idx+1])} for c_idx, val in enumerate(row)]
             while len(row_cells) < DATA_COLS_TO_KEEP:
                 row_cells.append({"value": "", "class": "wrap-text"})
-            page_data.append({"excel_row_num": r_idx + 1, "cells": row_cells})
+            page_data.append({"excel_row_num": int(r_idx) + 1, "cells": row_cells})
         while len(page_data) < ROWS_PER_PAGE:
             page_data.append({"excel_row_num": " ", "cells": [{"value": "", "class": "wrap-text"}]*DATA_COLS_TO_KEEP})
 
-        page_html_path = os.path.join(html_dir, f"{file_name}_{sheet_name}_page_{i+1}.html")
-        with open(page_html_path, 'w', encoding='utf-8') as f:
-            f.write(template.render({"title": f"{file_name} - {sheet_name} - P{i+1}", "page_data": page_data, "column_widths": col_widths}))
-        generated_files.append((f"PAGE_{i+1}", page_html_path, sheet_name))
+        page_name = f"{file_name}_{sheet_name}_page_{i+1}"
+        page_title = f"{file_name} - {sheet_name} - P{i+1}"
+        page_html = None
+        if render_html:
+            page_html = template.render({"title": page_title, "page_data": page_data, "column_widths": col_widths})
+        page_html_path = None
+        if html_dir is not None and page_html is not None:
+            page_html_path = os.path.join(html_dir, f"{page_name}.html")
+            with open(page_html_path, 'w', encoding='utf-8') as f:
+                f.write(page_html)
+            page_html = None
+        keep_context = keep_page_data or bool(page_leaks)
+        context_path = None
+        if html_dir is not None and keep_page_data and not page_leaks:
+            context_path = os.path.join(html_dir, f"{page_name}.json")
+            with open(context_path, 'w', encoding='utf-8') as f:
+                json.dump({"title": page_title, "column_widths": col_widths, "page_data": page_data}, f, ensure_ascii=False)
+            keep_context = False
+        generated_files.append({
+            "type": f"PAGE_{i+1}",
+            "sheet": sheet_name,
+            "page": i + 1,
+            "name": page_name,
+            "html_path": page_html_path,
+            "html": page_html,
+            "context_path": context_path,
+            "title": page_title if keep_context else None,
+            "column_widths": col_widths if keep_context else None,
+            "page_data": page_data if keep_context else None,
+            "leaks": page_leaks,
+            "content_key": page_content_key(col_widths, page_data)
+        })
         
     return generated_files
 
+def convert_openpyxl_cell(cell):
+    """Convert a read-only openpyxl cell the same way pandas.read_excel does."""
+    value = cell.value
+    if value is None or cell.data_type == 'e':
+        return math.nan
+    if isinstance(value, str):
+        return math.nan if value in STREAM_NA_VALUES else value
+    if cell.data_type == 'n' and isinstance(value, float) and math.isfinite(value) and value.is_integer():
+        return int(value)
+    return value
+
+def convert_xlrd_cell(value, cell_type, datemode):
+    """Convert an xlrd cell value/type pair the same way pandas.read_excel does."""
+    if cell_type in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+        return math.nan
+    if cell_type == xlrd.XL_CELL_DATE:
+        try:
+            value = xlrd.xldate.xldate_as_datetime(value, datemode)
+        except OverflowError:
+            return value
+        if value.timetuple()[0:3] in ((1899, 12, 31), (1904, 1, 1)):
+            return value.time()
+        return value
+    if cell_type == xlrd.XL_CELL_BOOLEAN:
+        return bool(value)
+    if cell_type == xlrd.XL_CELL_NUMBER:
+        if math.isfinite(value) and value.is_integer():
+            return int(value)
+        return value
+    return math.nan if value in STREAM_NA_VALUES else value
+
+def trim_stream_row(row):
+    """Drop trailing missing cells, like pandas does before padding rows."""
+    while row and isinstance(row[-1], float) and math.isnan(row[-1]):
+        row.pop()
+    return row
+
+def check_sheet_names(sheet_names, available):
+    missing = [name for name in sheet_names or [] if name not in available]
+    if missing:
+        raise ValueError(f"Worksheet(s) not found: {', '.join(missing)}")
+
+def read_workbook(excel_path, sheet_names=None, start_row=1, end_row=None):
+    """
+    pd.read_excel of the selected sheets (all when sheet_names is None), reading only Excel
+    rows start_row..end_row. The index stays the 0-based Excel row, so row numbers are kept.
+    """
+    nrows = None if end_row is None else end_row - start_row + 1
+    all_sheets = pd.read_excel(
+        excel_path, sheet_name=list(sheet_names) if sheet_names else None, header=None,
+        skiprows=start_row - 1, nrows=nrows
+    )
+    if start_row > 1:
+        for sheet_name, df in all_sheets.items():
+            # pandas sizes the columns from the skipped rows too; keep only what the range uses
+            used = df.notna().any().to_numpy().nonzero()[0]
+            df = df.iloc[:, :used[-1] + 1 if len(used) else 0]
+            df.index = df.index + (start_row - 1)
+            all_sheets[sheet_name] = df
+    return all_sheets
+
+def iter_workbook_sheets(excel_path, sheet_names=None, start_row=1, end_row=None):
+    """
+    Yield (sheet_name, open_rows) for each sheet, one sheet at a time.
+    open_rows() returns a fresh iterator of converted rows with trailing blanks trimmed,
+    so a sheet can be scanned more than once without being held in memory.
+    sheet_names limits (and orders) the sheets; only Excel rows start_row..end_row are read.
+    """
+    if excel_path.lower().endswith(".xls"):
+        book = xlrd.open_workbook(excel_path, on_demand=True)
+        try:
+            check_sheet_names(sheet_names, book.sheet_names())
+            for sheet_name in sheet_names or book.sheet_names():
+                sheet = book.sheet_by_name(sheet_name)
+
+                def open_rows(sheet=sheet):
+                    last_row = sheet.nrows if end_row is None else min(sheet.nrows, end_row)
+                    for r in range(start_row - 1, last_row):
+                        yield trim_stream_row([
+                            convert_xlrd_cell(value, cell_type, book.datemode)
+                            for value, cell_type in zip(sheet.row_values(r), sheet.row_types(r))
+                        ])
+
+                yield sheet_name, open_rows
+                book.unload_sheet(sheet_name)
+        finally:
+            book.release_resources()
+    else:
+        book = openpyxl.load_workbook(excel_path, read_only=True, data_only=True, keep_links=False)
+        try:
+            check_sheet_names(sheet_names, book.sheetnames)
+            for sheet in [book[name] for name in sheet_names] if sheet_names else book.worksheets:
+                sheet.reset_dimensions()
+
+                def open_rows(sheet=sheet):
+                    for row in sheet.iter_rows(min_row=start_row, max_row=end_row):
+                        yield trim_stream_row([convert_openpyxl_cell(cell) for cell in row])
+
+                yield sheet.title, open_rows
+        finally:
+            book.close()
+
+def split_facebook_header(rows, first_row=1):
+    """
+    Read the first FACEBOOK_URL_SCAN_ROWS rows and return (header, head, rows): the rows
+    remove_header_rows_with_facebook_url would delete, the read rows after them, and the
+    rest of the rows iterator. The header check only applies from Excel row 1.
+    """
+    rows = iter(rows)
+    head = []
+    for row in rows if first_row == 1 else ():
+        head.append(row)
+        if len(head) >= FACEBOOK_URL_SCAN_ROWS:
+            break
+    for row_idx, row in enumerate(head):
+        if any(FACEBOOK_URL_TO_CHECK.lower() in str(cell).strip().lower() for cell in row):
+            return head[:row_idx + 1], head[row_idx + 1:], rows
+    return [], head, rows
+
+def scan_sheet_layout(rows, first_row=1):
+    """
+    First streaming pass over a sheet. Returns (width, numeric_columns) where width is
+    the padded column count pandas would use and numeric_columns maps column index to
+    the dtype the cleaned DataFrame would have ("int64", "float64" or, for columns
+    holding only dates, "datetime64"). Like clean_dataframe_cells, types are inferred
+    from the rows left once the Facebook header rows are removed.
+    Only one chunk of values per column is buffered at a time.
+    """
+    chunk_size = STREAM_WINDOW_PAGES * ROWS_PER_PAGE
+    header, head, rows = split_facebook_header(rows, first_row)
+    width = max([0] + [len(row) for row in header])
+    data_rows = 0
+    row_count = 0
+    present = {}
+    kinds = {}
+    pending = {}
+
+    def check(col):
+        values = pending.pop(col, [])
+        if kinds.get(col) is None or not values:
+            return
+        if all(isinstance(value, datetime.datetime) for value in values):
+            kinds[col].add('M')
+            return
+        try:
+            kinds[col].add(pd.to_numeric(pd.Series(values, dtype=object)).dtype.kind)
+        except (ValueError, TypeError):
+            kinds[col] = None
+
+    for row in itertools.chain(head, rows):
+        row_count += 1
+        if not row:
+            continue
+        data_rows = row_count
+        width = max(width, len(row))
+        for col, value in enumerate(row):
+            if isinstance(value, float) and math.isnan(value):
+                continue
+            present[col] = present.get(col, 0) + 1
+            if col not in kinds:
+                kinds[col] = set()
+            if kinds[col] is not None:
+                pending.setdefault(col, []).append(value)
+                if len(pending[col]) >= chunk_size:
+                    check(col)
+
+    numeric_columns = {}
+    for col in list(kinds):
+        check(col)
+        col_kinds = kinds[col]
+        if col_kinds == {'M'}:
+            numeric_columns[col] = "datetime64"
+            continue
+        if not col_kinds or 'u' in col_kinds or 'c' in col_kinds or 'M' in col_kinds:
+            continue
+        if 'f' in col_kinds or present[col] < data_rows:
+            numeric_columns[col] = "float64"
+        elif 'i' in col_kinds:
+            numeric_columns[col] = "int64"
+    return width, numeric_columns
+
+def stream_sheet_blocks(rows, width=0, numeric_columns=None, first_row=1):
+    """
+    Streaming counterpart of Step 0a/0b: removes Facebook header rows and restricted
+    cells row by row and yields DataFrame blocks of non-empty rows.
+    Blocks hold at most STREAM_WINDOW_PAGES pages and always a whole number of pages,
+    so they can be fed to generate_html_for_sheet one after another.
+    width and numeric_columns come from scan_sheet_layout and make each block look
+    like the matching slice of the pd.read_excel DataFrame. first_row is the Excel row
+    the rows start at; the Facebook header check only applies from row 1.
+    """
+    block_rows = STREAM_WINDOW_PAGES * ROWS_PER_PAGE
+    numeric_columns = numeric_columns or {}
+    header, head, rows = split_facebook_header(rows, first_row)
+    if header:
+        log(f"[Cleanup] Found Facebook URL at row {len(header)}, removing {len(header)} header rows")
+
+    cleaned_count = 0
+    positions = []
+    values = []
+
+    def make_block():
+        block_width = min(max([width] + [len(row) for row in values]), DATA_COLS_TO_KEEP)
+        block = pd.DataFrame(
+            [row + [math.nan] * (block_width - len(row)) for row in values],
+            index=positions,
+            dtype=object
+        )
+        for col, dtype in numeric_columns.items():
+            if col >= block_width:
+                continue
+            if dtype == "datetime64":
+                block[col] = pd.to_datetime(block[col])
+            else:
+                block[col] = pd.to_numeric(block[col]).astype(dtype)
+        return block
+
+    for position, row in enumerate(itertools.chain(head, rows), start=first_row - 1):
+        kept = []
+        for cell in row[:DATA_COLS_TO_KEEP]:
+            if _remove_cell_cache(cell):
+                cleaned_count += 1
+                kept.append("")
+            else:
+                kept.append(cell)
+        if not any(str(cell).strip() != '' and str(cell).strip().lower() != 'nan' for cell in kept):
+            continue
+        positions.append(position)
+        values.append(kept)
+        if len(values) >= block_rows:
+            yield make_block()
+            positions, values = [], []
+
+    if values:
+        yield make_block()
+
+    if cleaned_count > 0:
+        log(f"[Cleanup] Removed content from {cleaned_count} cells containing restricted keywords")
+
 def add_blur_to_image(image_path, blur_radius=COVER_BLUR_RADIUS):
     """Apply Gaussian blur to an image for preview protection."""
     try:
@@ -277,171 +880,1236 @@ def add_blur_to_image(image_path, blur_radius=COVER_BLUR_RADIUS):
     except Exception as e:
         log(f"Blur error: {e}")
 
-def add_watermark_to_image(image_path, apply_blur=False):
+def save_watermarked_image(image, image_path, apply_blur=False, output=None):
+    """Watermark an in-memory page image and save it (unwatermarked if watermarking fails)."""
     try:
-        base_image = Image.open(image_path).convert("RGBA")
-        width, height = base_image.size
-        
-        if apply_blur:
-            base_image = base_image.filter(ImageFilter.GaussianBlur(radius=COVER_BLUR_RADIUS))
-        
-        txt_layer = Image.new("RGBA", base_image.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(txt_layer)
-        
-        font_size = int(width / 25)
-        try:
-            font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-            if not os.path.exists(font_path):
-                font_path = "arial.ttf"
-            if os.path.exists(font_path):
-                font = ImageFont.truetype(font_path, font_size)
-            else:
-                font = ImageFont.load_default()
-        except IOError:
-            font = ImageFont.load_default()
-        
-        step_x = width / GRID_COLS
-        step_y = height / GRID_ROWS
-        
-        text_color = (150, 150, 150, WATERMARK_OPACITY)
-        
-        for r in range(GRID_ROWS):
-            for c in range(GRID_COLS):
-                center_x = (c * step_x) + (step_x / 2)
-                center_y = (r * step_y) + (step_y / 2)
-                
-                bbox = draw.textbbox((0, 0), WATERMARK_TEXT, font=font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-                
-                x = center_x - (text_w / 2)
-                y = center_y - (text_h / 2)
-                
-                draw.text((x, y), WATERMARK_TEXT, font=font, fill=text_color)
-        
-        combined = Image.alpha_composite(base_image, txt_layer)
-        combined = combined.convert("RGB")
-        combined.save(image_path)
-        
+        image = apply_watermark(image, apply_blur=apply_blur)
     except Exception as e:
         log(f"Watermark error: {e}")
+    return encode_image(image, image_path, output)
 
-def create_images_from_list(html_list, file_name, image_dir):
-    created_images = []
-    global_image_index = 0
+def encode_image(image, image_path, output=None):
+    """
+    Save image with the encoder in output ({"format", "quality", "compress_level", "quantizer"},
+    module defaults for anything missing) and return its size in bytes and the encode time in ms.
+    A quantizer (PaletteQuantizer) turns PNG pages into palette images first.
+    """
+    output = output or {}
+    image_format = output.get("format", IMAGE_FORMAT)
+    quality = output.get("quality", IMAGE_QUALITY)
+    quantizer = output.get("quantizer")
+    started = time.perf_counter()
+    if image_format == "png":
+        if quantizer is not None:
+            image = quantizer(image)
+        image.save(image_path, "PNG", compress_level=output.get("compress_level", PNG_COMPRESS_LEVEL))
+    elif image_format == "webp":
+        image.save(image_path, "WEBP", lossless=True, method=WEBP_METHOD)
+    elif image_format == "webp-lossy":
+        image.save(image_path, "WEBP", quality=quality, method=WEBP_METHOD)
+    elif image_format == "jpeg":
+        image.convert("RGB").save(image_path, "JPEG", quality=quality)
+    else:
+        raise ValueError(f"unknown image format {image_format!r}")
+    return {
+        "bytes": os.path.getsize(image_path),
+        "encodeMs": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+class PaletteQuantizer:
+    """
+    Quantizes the pages of one run to at most colors colors without dithering. The shared
+    palette is built once, up front, from palette_sample_image(); a page it cannot hold
+    within PALETTE_MAX_ERROR gets an adaptive palette of its own. Every page therefore
+    comes out the same whatever order the post-processing threads reach it in.
+    """
+
+    def __init__(self, colors, max_error=PALETTE_MAX_ERROR):
+        self.colors = colors
+        self.max_error = max_error
+        self.palette = palette_sample_image().quantize(colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+        self.lock = threading.Lock()
+        self.shared = 0
+        self.adaptive = 0
+
+    def __call__(self, image):
+        image = image.convert("RGB")
+        quantized = image.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        if palette_error(image, quantized) <= self.max_error:
+            with self.lock:
+                self.shared += 1
+            return quantized
+        with self.lock:
+            self.adaptive += 1
+        return image.quantize(self.colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+    def stats(self):
+        return {"colors": self.colors, "shared": self.shared, "adaptive": self.adaptive}
+
+def palette_sample_image():
+    """A page of sample cells drawn like the Pillow renderer and watermarked (blurred pages rarely fit any shared palette)."""
+    text = "Nguyễn Văn ** 09**5*78 ***@gmail.com Hà Nội, Quận ** - ABC xyz 0123456789"
+    page_data = [
+        {"excel_row_num": r + 1, "cells": [{"value": text, "class": "wrap-text" if r % 2 else "no-wrap-text"}] * DATA_COLS_TO_KEEP}
+        for r in range(ROWS_PER_PAGE)
+    ]
+    return apply_watermark(draw_table_image([INDEX_COL_WIDTH] + [OTHER_COL_WIDTH] * DATA_COLS_TO_KEEP, page_data))
+
+def palette_error(image, quantized):
+    """Largest per-channel RMS difference between an RGB image and its quantized version."""
+    return max(ImageStat.Stat(ImageChops.difference(image, quantized.convert("RGB"))).rms)
+
+def apply_watermark(image, apply_blur=False):
+    """Return an RGB copy of image with the watermark grid drawn over it (blurred first if requested)."""
+    base_image = image.convert("RGBA")
     
-    with sync_playwright() as p:
-        launch_args = [
-            "--no-sandbox", 
-            "--disable-setuid-sandbox",
-            "--disable-dev-shm-usage",
-            "--disable-gpu",
-            "--single-process"
-        ]
-        
-        log("[Pipeline] Starting browser (System Chromium)...")
-        browser = None
+    if apply_blur:
+        base_image = base_image.filter(ImageFilter.GaussianBlur(radius=COVER_BLUR_RADIUS))
+    
+    combined = Image.alpha_composite(base_image, get_watermark_overlay(base_image.size))
+    return combined.convert("RGB")
+
+def get_watermark_overlay(size):
+    """The transparent watermark layer for an image size, built once and shared by every page of that size."""
+    overlay = _watermark_overlay_cache.get(size)
+    if overlay is None:
+        with _watermark_overlay_lock:
+            overlay = _watermark_overlay_cache.get(size)
+            if overlay is None:
+                overlay = _watermark_overlay_cache[size] = build_watermark_overlay(size)
+    return overlay
+
+def build_watermark_overlay(size):
+    """Draw the GRID_ROWS x GRID_COLS watermark text grid on a transparent layer."""
+    width, height = size
+    txt_layer = Image.new("RGBA", size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(txt_layer)
+    
+    font_size = int(width / 25)
+    try:
+        font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+        if not os.path.exists(font_path):
+            font_path = "arial.ttf"
+        if os.path.exists(font_path):
+            font = ImageFont.truetype(font_path, font_size)
+        else:
+            font = ImageFont.load_default()
+    except IOError:
+        font = ImageFont.load_default()
+    
+    step_x = width / GRID_COLS
+    step_y = height / GRID_ROWS
+    
+    text_color = (150, 150, 150, WATERMARK_OPACITY)
+    bbox = draw.textbbox((0, 0), WATERMARK_TEXT, font=font)
+    text_w = bbox[2] - bbox[0]
+    text_h = bbox[3] - bbox[1]
+    
+    for r in range(GRID_ROWS):
+        for c in range(GRID_COLS):
+            center_x = (c * step_x) + (step_x / 2)
+            center_y = (r * step_y) + (step_y / 2)
+            
+            x = center_x - (text_w / 2)
+            y = center_y - (text_h / 2)
+            
+            draw.text((x, y), WATERMARK_TEXT, font=font, fill=text_color)
+    
+    return txt_layer
+
+def get_table_font(size=TABLE_FONT_SIZE):
+    """Bold table font, loaded once per size and render thread (FreeType faces are not shared across threads)."""
+    fonts = getattr(_table_font_cache, "fonts", None)
+    if fonts is None:
+        fonts = _table_font_cache.fonts = {}
+    font = fonts.get(size)
+    if font is None:
+        font_path = next((path for path in TABLE_FONT_PATHS if os.path.exists(path)), None)
         try:
-            # Priority 1: Use channel chromium (system installed)
-            browser = p.chromium.launch(channel="chromium", args=launch_args)
-        except Exception as e1:
-            log(f"[Pipeline] Channel chromium failed: {e1}")
+            font = ImageFont.truetype(font_path or "arialbd.ttf", size)
+        except IOError:
+            font = ImageFont.load_default(size)
+        fonts[size] = font
+    return font
+
+def get_table_grid(column_widths):
+    """
+    Cell edges of the page table as Chromium lays out template.html: the table fills
+    the 2000x1300 body at the default 8px body margin, fixed-layout columns are
+    stretched proportionally and the ten rows share the table height.
+    """
+    scale = TARGET_WIDTH / sum(column_widths)
+    xs = [TABLE_MARGIN]
+    total = 0
+    for width in column_widths:
+        total += width
+        xs.append(TABLE_MARGIN + round(total * scale))
+    row_height = max(ROW_HEIGHT, TARGET_HEIGHT / ROWS_PER_PAGE)
+    ys = [TABLE_MARGIN + round(r * row_height) for r in range(ROWS_PER_PAGE + 1)]
+    return xs, ys
+
+def wrap_cell_text(text, font, max_width):
+    """Greedy word wrap that also breaks words longer than a line (CSS word-wrap: break-word)."""
+    lines = []
+    line = ""
+    for word in text.split(" "):
+        candidate = f"{line} {word}" if line else word
+        if font.getlength(candidate) <= max_width:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        line = ""
+        for char in word:
+            if line and font.getlength(line + char) > max_width:
+                lines.append(line)
+                line = ""
+            line += char
+    if line:
+        lines.append(line)
+    return lines
+
+def ellipsize_cell_text(text, font, max_width):
+    """Single line cut to max_width with a trailing ellipsis (white-space: nowrap; text-overflow: ellipsis)."""
+    if font.getlength(text) <= max_width:
+        return text
+    while text and font.getlength(text + "\u2026") > max_width:
+        text = text[:-1]
+    return text + "\u2026"
+
+def draw_table_image(column_widths, page_data, scale=1):
+    """
+    Draw one page table with Pillow, matching the Chromium screenshot of template.html.
+    scale < 1 draws a proportionally smaller page (for blurred pages): lines are wrapped
+    and cut with the full-size font, so the page breaks its text exactly like the full
+    one, then drawn scaled down; the borders are lightened so they blur to the same
+    strength as 1px lines at full size.
+    """
+    image = Image.new("RGB", (round(TARGET_WIDTH * scale), round(TARGET_HEIGHT * scale)), "white")
+    draw = ImageDraw.Draw(image)
+    font = get_table_font()
+    draw_font = font if scale == 1 else get_table_font(TABLE_FONT_SIZE * scale)
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent
+    xs, ys = get_table_grid(column_widths)
+    padding_x, padding_y, border = TABLE_CELL_PADDING_X, TABLE_CELL_PADDING_Y, 1
+
+    for r, row_data in enumerate(page_data):
+        cells = [{"value": row_data["excel_row_num"], "class": "index-col"}] + row_data["cells"]
+        top = ys[r] + border + padding_y
+        max_lines = max(1, int((ys[r + 1] - ys[r] - border - 2 * padding_y) // line_height))
+        for c, cell in enumerate(cells):
+            # HTML collapses runs of whitespace into single spaces
+            text = " ".join(str(cell["value"]).split())
+            if not text:
+                continue
+            left = xs[c] + border + padding_x
+            text_width = xs[c + 1] - xs[c] - border - 2 * padding_x
+            if cell["class"] == "wrap-text":
+                lines = wrap_cell_text(text, font, text_width)[:max_lines]
+            else:
+                lines = [ellipsize_cell_text(text, font, text_width)]
+            for n, line in enumerate(lines):
+                x = left
+                if cell["class"] == "index-col":
+                    x = left + (text_width - font.getlength(line)) / 2
+                draw.text((x * scale, (top + n * line_height) * scale), line, font=draw_font, fill=TABLE_TEXT_COLOR)
+
+    border_color = TABLE_BORDER_COLOR
+    if scale != 1:
+        xs = [round(x * scale) for x in xs]
+        ys = [round(y * scale) for y in ys]
+        border_color = tuple(round(255 - (255 - channel) * scale) for channel in TABLE_BORDER_COLOR)
+    for x in xs:
+        draw.line([(x, ys[0]), (x, ys[-1])], fill=border_color, width=1)
+    for y in ys:
+        draw.line([(xs[0], y), (xs[-1], y)], fill=border_color, width=1)
+    return image
+
+def launch_browser(p):
+    log("[Pipeline] Starting browser (System Chromium)...")
+    browser = None
+    try:
+        # Priority 1: Use channel chromium (system installed)
+        browser = p.chromium.launch(channel="chromium", args=BROWSER_LAUNCH_ARGS)
+    except Exception as e1:
+        log(f"[Pipeline] Channel chromium failed: {e1}")
+        try:
+            # Priority 2: Try to find specific path (common on Nix)
+            executable_path = shutil.which("chromium")
+            if executable_path:
+                log(f"[Pipeline] Found chromium at: {executable_path}")
+                browser = p.chromium.launch(executable_path=executable_path, args=BROWSER_LAUNCH_ARGS)
+            else:
+                # Priority 3: Use default playwright browser
+                log("[Pipeline] Trying default playwright browser...")
+                browser = p.chromium.launch(args=BROWSER_LAUNCH_ARGS)
+        except Exception as e2:
+            log(f"[Pipeline] All browser launch methods failed: {e2}")
+            raise e2
+    return browser
+
+class RenderPool:
+    """
+    A fixed number of render threads, each owning its own Playwright driver, Chromium
+    process and page (the sync API may only be used from the thread that started it).
+    Tasks are functions called as fn(page, *args) by whichever worker is free;
+    setup(page), if given, runs once per page before its first task.
+    With use_browser=False the workers start no browser and page is None.
+    broken is set once a worker has lost its browser; its remaining tasks fail.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, setup=None, use_browser=True):
+        self.workers = max(1, int(workers))
+        self.setup = setup
+        self.use_browser = use_browser
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.broken = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(cancel_pending=exc_type is not None)
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"render-{n + 1}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.tasks.put((fn, args, future))
+        return future
+
+    def close(self, cancel_pending=False):
+        if cancel_pending:
+            while True:
+                try:
+                    task = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    task[2].cancel()
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _run(self):
+        if not self.use_browser:
+            self._serve(None)
+            return
+        served = False
+        try:
+            with sync_playwright() as p:
+                browser = launch_browser(p)
+                page = browser.new_page()
+                page.set_viewport_size({"width": TARGET_WIDTH, "height": TARGET_HEIGHT})
+                if self.setup is not None:
+                    self.setup(page)
+                self._serve(page)
+                served = True
+                browser.close()
+        except Exception as e:
+            if not served:
+                # Browser could not start or be set up: fail whatever this worker picks up
+                self._serve(None, error=e)
+            else:
+                log(f"[Pipeline] Browser shutdown error: {e}")
+
+    def _serve(self, page, error=None):
+        if error is not None:
+            self.broken = True
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            fn, args, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+                continue
             try:
-                # Priority 2: Try to find specific path (common on Nix)
-                executable_path = shutil.which("chromium")
-                if executable_path:
-                    log(f"[Pipeline] Found chromium at: {executable_path}")
-                    browser = p.chromium.launch(executable_path=executable_path, args=launch_args)
-                else:
-                    # Priority 3: Use default playwright browser
-                    log("[Pipeline] Trying default playwright browser...")
-                    browser = p.chromium.launch(args=launch_args)
-            except Exception as e2:
-                log(f"[Pipeline] All browser launch methods failed: {e2}")
-                raise e2
-        
-        page = browser.new_page()
-        page.set_viewport_size({"width": TARGET_WIDTH, "height": TARGET_HEIGHT})
+                future.set_result(fn(page, *args))
+            except Exception as e:
+                future.set_exception(e)
+                if page is not None and page.is_closed():
+                    error = e
+                    self.broken = True
+
+def capture_page_html(page, html_page):
+    if html_page["html"] is not None:
+        page.set_content(html_page["html"])
+    else:
+        page.goto(f"file://{os.path.abspath(html_page['html_path'])}")
+    return capture_page_image(page)
+
+def capture_page_image(page):
+    """Screenshot the viewport and decode Playwright's PNG in memory; the watermarked page is encoded again when saved (no temp file)."""
+    return Image.open(io.BytesIO(page.screenshot(full_page=False)))
+
+def build_template_skeleton(template):
+    """Render template.html once with blank cells, to be filled by UPDATE_CELLS_JS."""
+    return template.render({
+        "title": "",
+        "page_data": [{"excel_row_num": " ", "cells": [{"value": "", "class": "wrap-text"}] * DATA_COLS_TO_KEEP}] * ROWS_PER_PAGE,
+        "column_widths": [INDEX_COL_WIDTH] + [OTHER_COL_WIDTH] * DATA_COLS_TO_KEEP
+    })
+
+def load_page_context(html_page):
+    """The template context (title, column_widths, page_data) of a page record, read from its context file if it has one."""
+    if html_page["context_path"] is None:
+        return html_page
+    with open(html_page["context_path"], encoding='utf-8') as f:
+        return json.load(f)
+
+def capture_page_cells(page, html_page):
+    context = load_page_context(html_page)
+    page.evaluate(UPDATE_CELLS_JS, {
+        "title": context["title"],
+        "column_widths": context["column_widths"],
+        "page_data": context["page_data"]
+    })
+    return capture_page_image(page)
+
+def capture_page_drawing(page, html_page):
+    context = load_page_context(html_page)
+    return draw_table_image(context["column_widths"], context["page_data"])
+
+def capture_page_blurred(page, html_page):
+    """Cheap capture for a page that is going to be blurred: the Pillow table at BLURRED_PAGE_SCALE."""
+    context = load_page_context(html_page)
+    image = draw_table_image(context["column_widths"], context["page_data"],
+                             scale=BLURRED_PAGE_SCALE * BLURRED_PAGE_SUPERSAMPLE)
+    return image.reduce(BLURRED_PAGE_SUPERSAMPLE)
+
+def finish_blurred_page(image, img_path, output=None):
+    """Blur a capture_page_blurred image at its own scale (radius scaled too), upscale and watermark it."""
+    image = image.filter(ImageFilter.GaussianBlur(radius=COVER_BLUR_RADIUS * BLURRED_PAGE_SCALE))
+    image = image.resize((TARGET_WIDTH, TARGET_HEIGHT), Image.BILINEAR)
+    return save_watermarked_image(image, img_path, output=output)
+
+def run_render_step(page, step, html_page, img_path, post=None, output=None):
+    """
+    Run one page through a render step (capture, finish) and return finish's encode stats.
+    Without post, both run on this render worker. With post = (executor, slots), capture
+    waits for a free slot (so the browser cannot run ahead of post-processing) and finish
+    is handed to the executor; the finish future is returned instead.
+    """
+    capture, finish = step
+    if post is None:
+        return finish(capture(page, html_page), img_path, output=output)
+    executor, slots = post
+    slots.acquire()
+    try:
+        image = capture(page, html_page)
+        future = executor.submit(finish, image, img_path, output=output)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+def make_render_pool(render_workers=RENDER_WORKERS, render_mode=RENDER_MODE, template=None, engine=RENDER_ENGINE):
+    """
+    An unstarted RenderPool set up for the render mode and engine, and the render step
+    for each page: (capture(page, html_page) -> image, finish(image, img_path, output=output)).
+    """
+    setup = None
+    capture = capture_page_html
+    if engine == "pillow":
+        capture = capture_page_drawing
+    elif render_mode == "template":
+        skeleton_html = build_template_skeleton(template)
+        setup = lambda page: page.set_content(skeleton_html)
+        capture = capture_page_cells
+    return RenderPool(render_workers, setup=setup, use_browser=engine == "chromium"), (capture, save_watermarked_image)
+
+def page_content_key(column_widths, page_data):
+    """Hash of a page's cells, classes, row numbers and column widths (stored as the record's "content_key")."""
+    content = json.dumps({"column_widths": column_widths, "page_data": page_data}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def page_key(settings, html_page, apply_blur):
+    """Hash of a page's render inputs under settings (a JSON string): its content_key and blur flag."""
+    content = json.dumps({"settings": settings, "blur": apply_blur, "content": html_page["content_key"]}, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+class PageCache:
+    """
+    Finished page images on disk, addressed by a hash of everything that decides their
+    pixels: the page's cells, classes and column widths, its blur flag and the run's
+    settings (template digest, engine, watermark and encoder options). Files live in
+    directory/<2 hex>/<hash><extension> and are copied in and out whole.
+    """
+
+    def __init__(self, directory, settings):
+        self.directory = directory
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, html_page, apply_blur):
+        return page_key(self.settings, html_page, apply_blur)
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key[:2], f"{key}{extension}")
+
+    def fetch(self, key, img_path):
+        """Copy the cached image for key to img_path and return its encode stats, or None on a miss."""
+        cached_path = self.path(key, os.path.splitext(img_path)[1])
+        try:
+            shutil.copyfile(cached_path, img_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"bytes": os.path.getsize(img_path), "encodeMs": 0.0}
+
+    def store(self, key, img_path):
+        """Add a freshly rendered image (written to a temp file first, so readers never see half a file)."""
+        cached_path = self.path(key, os.path.splitext(img_path)[1])
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        temp_path = f"{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(img_path, temp_path)
+            os.replace(temp_path, cached_path)
+        except OSError as e:
+            log(f"[Cache] Could not store {os.path.basename(img_path)}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+def page_cache_settings(template_path, engine, render_mode, blurred_pages, output):
+    """The run-wide part of a PageCache key."""
+    with open(template_path, "rb") as f:
+        template_digest = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "version": PAGE_CACHE_VERSION,
+        "template": template_digest,
+        "engine": engine,
+        "render_mode": render_mode,
+        "blurred_pages": blurred_pages,
+        "blurred_page_scale": BLURRED_PAGE_SCALE,
+        "size": [TARGET_WIDTH, TARGET_HEIGHT],
+        "watermark": [WATERMARK_TEXT, WATERMARK_OPACITY, GRID_COLS, GRID_ROWS],
+        "blur_radius": COVER_BLUR_RADIUS,
+        "output": output
+    }
+
+class ProgressManifest:
+    """
+    Append-only list of the pages finished in an output directory (PROGRESS_MANIFEST): one
+    JSON line per page with its page_key, image path (relative to the directory) and encode
+    stats, flushed as each page completes. With resume=True the lines of an earlier run are
+    read first, and a page whose image is still there, intact and made from the same inputs
+    is handed back by fetch instead of being rendered again.
+    """
+
+    def __init__(self, output_dir, settings, resume=False):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, PROGRESS_MANIFEST)
+        self.settings = json.dumps(settings, sort_keys=True)
+        self.done = {}
+        self.resumed = 0
+        complete = True
+        if resume and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                content = f.read()
+            complete = content.endswith("\n") or not content
+            for line in content.splitlines():
+                try:
+                    entry = json.loads(line)
+                    self.done[entry["image"]] = {"key": entry["key"], "bytes": entry["bytes"], "encodeMs": entry["encodeMs"]}
+                except (ValueError, KeyError, TypeError):
+                    # The last line of a run that was killed while writing it, or a damaged one
+                    continue
+        self.file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        if not complete:
+            self.file.write("\n")
+
+    def key(self, html_page, apply_blur):
+        return page_key(self.settings, html_page, apply_blur)
+
+    def fetch(self, key, img_path):
+        """Encode stats of the earlier run's image at img_path if it can be kept, else None."""
+        entry = self.done.get(os.path.relpath(img_path, self.output_dir))
+        if entry is None or entry["key"] != key:
+            return None
+        try:
+            if os.path.getsize(img_path) != entry["bytes"]:
+                return None
+            with Image.open(img_path) as image:
+                image.verify()
+        except Exception:
+            return None
+        self.resumed += 1
+        return {"bytes": entry["bytes"], "encodeMs": entry["encodeMs"]}
+
+    def record(self, key, img_path, stats):
+        entry = {"key": key, "image": os.path.relpath(img_path, self.output_dir), **stats}
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ResultCache:
+    """
+    Finished runs by workbook fingerprint (see workbook_fingerprint): directory/<fingerprint>/
+    holds result.json and the page images as <n><extension>, in result order. A stored run is
+    handed out under any file name, with its images copied to where that run would put them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, fingerprint, file_name, image_dir):
+        """
+        The stored result for fingerprint with its images copied under file_name in image_dir,
+        or None. An entry that cannot be read back (damaged result.json, missing image) is
+        dropped and counts as a miss, so the run renders and stores it again.
+        """
+        entry = os.path.join(self.directory, fingerprint)
+        if not os.path.exists(entry):
+            return None
+        try:
+            with open(os.path.join(entry, "result.json"), encoding="utf-8") as f:
+                result = json.load(f)
+            images = []
+            for image in result["images"]:
+                sheet_dir = os.path.join(image_dir, file_name, image["sheet"])
+                os.makedirs(sheet_dir, exist_ok=True)
+                extension = os.path.splitext(image["path"])[1]
+                img_path = os.path.join(sheet_dir, f"{file_name}_{image['sheet']}_page_{image['page']}{extension}")
+                shutil.copyfile(os.path.join(entry, image["path"]), img_path)
+                images.append({**image, "path": img_path})
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log(f"[Cache] Dropping damaged result {fingerprint}: {e}")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        result.update({
+            "fileName": file_name,
+            "totalImages": len(images),
+            "coverPhoto": images[0]["path"] if images else None,
+            "images": images,
+            "outputDir": image_dir,
+            "resultCache": {"hit": True, "fingerprint": fingerprint}
+        })
+        return result
+
+    def store(self, fingerprint, result):
+        """Add a successful result (built in a temp directory and renamed into place; the first run to finish wins)."""
+        entry = os.path.join(self.directory, fingerprint)
+        if os.path.exists(entry):
+            return
+        temp_entry = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(temp_entry)
+            images = []
+            for n, image in enumerate(result["images"]):
+                stored_name = f"{n}{os.path.splitext(image['path'])[1]}"
+                shutil.copyfile(image["path"], os.path.join(temp_entry, stored_name))
+                images.append({**image, "path": stored_name})
+            stored = {key: value for key, value in result.items() if key not in ("fileName", "coverPhoto", "outputDir")}
+            stored["images"] = images
+            with open(os.path.join(temp_entry, "result.json"), 'w', encoding='utf-8') as f:
+                json.dump(stored, f, ensure_ascii=False, indent=2)
+            os.rename(temp_entry, entry)
+        except OSError as e:
+            if not os.path.exists(entry):
+                log(f"[Cache] Could not store result {fingerprint}: {e}")
+        finally:
+            shutil.rmtree(temp_entry, ignore_errors=True)
+
+def result_cache_settings(page_settings, start_row):
+    """Everything besides the cells that decides a run's result: render settings and the cleanup and masking rules."""
+    return {
+        **page_settings,
+        "header_cleanup": start_row == 1,
+        "facebook_url": FACEBOOK_URL_TO_CHECK,
+        "remove_keywords": KEYWORDS_TO_REMOVE_CELL,
+        "mask_keywords": KEYWORDS_TO_MASK,
+        "leak_tolerance": MAX_LEAK_TOLERANCE,
+        "layout": [ROWS_PER_PAGE, DATA_COLS_TO_KEEP, FREE_PREVIEW_IMAGES]
+    }
+
+def workbook_fingerprint(sheets, settings):
+    """
+    Hash of parsed sheets ({name: DataFrame}) and settings: sheet names, dtypes, row
+    labels and cell values only, so neither the file name nor the xlsx packaging matters.
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for sheet_name, df in sheets.items():
+        digest.update(json.dumps([sheet_name, [str(dtype) for dtype in df.dtypes]], ensure_ascii=False).encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def stream_workbook_fingerprint(excel_path, settings, sheet_names=None, start_row=1, end_row=None):
+    """workbook_fingerprint for --stream, from one pass over the converted rows instead of DataFrames."""
+    digest = hashlib.sha256(json.dumps({**settings, "stream": True}, sort_keys=True).encode("utf-8"))
+    for sheet_name, open_rows in iter_workbook_sheets(excel_path, sheet_names, start_row, end_row):
+        digest.update(json.dumps(sheet_name, ensure_ascii=False).encode("utf-8"))
+        for row in open_rows():
+            digest.update(repr(row).encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+class FileSystemStore:
+    """Object store in a local directory (file:///...), e.g. a mounted bucket or a test stand-in."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, path, key, content_type):
+        target = os.path.join(self.root, *key.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, temp_path)
+        os.replace(temp_path, target)
+        return "file://" + urllib.parse.quote(os.path.abspath(target))
+
+class S3Store:
+    """
+    S3-compatible bucket (s3://...), reached like doSpaces.ts does: DO_ENDPOINT, DO_ACCESS_KEY
+    and DO_SECRET_KEY, public-read objects. One boto3 client with a connection pool of
+    max_connections serves every upload thread. URLs use UPLOAD_PUBLIC_URL when set, else
+    the bucket's Spaces CDN address.
+    """
+
+    def __init__(self, bucket, max_connections=UPLOAD_WORKERS):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("s3:// uploads need boto3, from the project's s3 extra (uv sync --extra s3)")
+        access_key = os.environ.get("DO_ACCESS_KEY")
+        secret_key = os.environ.get("DO_SECRET_KEY")
+        if not access_key or not secret_key:
+            raise RuntimeError("DO_ACCESS_KEY and DO_SECRET_KEY are required for s3:// uploads")
+        self.bucket = bucket
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=os.environ.get("DO_ENDPOINT", UPLOAD_DEFAULT_ENDPOINT),
+            region_name=UPLOAD_REGION,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=Config(max_pool_connections=max_connections)
+        )
+        self.public_url = os.environ.get("UPLOAD_PUBLIC_URL", f"https://{bucket}.{UPLOAD_REGION}.cdn.digitaloceanspaces.com")
+
+    def put(self, path, key, content_type):
+        with open(path, "rb") as f:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=f, ContentType=content_type, ACL="public-read")
+        return f"{self.public_url.rstrip('/')}/{urllib.parse.quote(key)}"
+
+def open_object_store(target, max_connections=UPLOAD_WORKERS):
+    """(store, key prefix) for an --upload-to target."""
+    parts = urllib.parse.urlsplit(target)
+    if parts.scheme == "file":
+        return FileSystemStore(urllib.parse.unquote(parts.path)), ""
+    if parts.scheme == "s3" and parts.netloc:
+        return S3Store(parts.netloc, max_connections), parts.path.strip("/")
+    raise ValueError(f"unsupported upload target {target!r} (expected s3://bucket/prefix or file:///directory)")
+
+class Uploader:
+    """
+    Upload stage: finished page images are pushed to an object store by up to workers threads
+    while the next pages render. Keys are prefix + the image path relative to root (the job's
+    output directory). Each upload is tried UPLOAD_RETRIES times with a doubling delay.
+    """
+
+    def __init__(self, target, root, workers=UPLOAD_WORKERS):
+        self.target = target
+        self.root = root
+        self.workers = max(1, int(workers))
+        self.store, self.prefix = open_object_store(target, self.workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload")
+        self.uploads = {}
+
+    def key(self, path):
+        relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return f"{self.prefix}/{relative}" if self.prefix else relative
+
+    def submit(self, path):
+        self.uploads[path] = self.executor.submit(self._upload, path, self.key(path))
+
+    def _upload(self, path, key):
+        content_type = UPLOAD_CONTENT_TYPES.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                return self.store.put(path, key, content_type)
+            except Exception as e:
+                if attempt == UPLOAD_RETRIES - 1:
+                    raise
+                log(f"[Upload] {key} failed ({e}), retrying")
+                time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+
+    def wait(self, images):
+        """
+        Wait for the uploads of images (submitting any that were not), set each image's "url"
+        (or "uploadError") and return the upload stats.
+        """
+        started = time.perf_counter()
+        failed = 0
+        for image in images:
+            if image["path"] not in self.uploads:
+                self.submit(image["path"])
+        for image in images:
+            try:
+                image["url"] = self.uploads.pop(image["path"]).result()
+            except Exception as e:
+                failed += 1
+                image["uploadError"] = str(e)
+                log(f"[Upload] Failed to upload {image['path']}: {e}")
+        stats = {
+            "target": self.target,
+            "uploaded": len(images) - failed,
+            "failed": failed,
+            "waitMs": round((time.perf_counter() - started) * 1000, 1)
+        }
+        log(f"[Upload] {stats['uploaded']} images uploaded to {self.target}, {failed} failed, {stats['waitMs']:.0f} ms after rendering")
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def create_images_from_list(html_list, file_name, image_dir, render_workers=RENDER_WORKERS, render_mode=RENDER_MODE, template=None,
+                            engine=RENDER_ENGINE, pool=None, on_preview=None, blurred_pages=BLURRED_PAGE_MODE,
+                            post_workers=POST_WORKERS, output=None, page_cache=None, manifest=None, on_image=None):
+    """
+    Render every page to a PNG. pool is an already started pool from make_render_pool
+    with the same render mode, template and engine (kept open); otherwise one is
+    started and closed for this call. on_preview(images) is called as soon as the clear
+    preview pages are done, while the blurred pages are still rendering.
+    blurred_pages="downscaled" renders blurred pages with capture_page_blurred (needs page_data).
+    post_workers threads blur, watermark and encode while the render workers capture the
+    next pages (0 does it all on the render workers). output picks the encoder (see encode_image).
+    page_cache (a PageCache) copies pages rendered before instead of rendering them.
+    manifest (a ProgressManifest) records every finished page and keeps the ones it can resume.
+    on_image(image, index, total) is called for each finished page, in page order.
+    """
+    blurred_step = (capture_page_blurred, finish_blurred_page) if blurred_pages == "downscaled" else None
+    if pool is not None:
+        step = make_render_pool(1, render_mode, template, engine)[1]
+        return render_images(pool, step, html_list, file_name, image_dir, on_preview, blurred_step, post_workers, output,
+                             page_cache, manifest, on_image)
+    new_pool, step = make_render_pool(render_workers, render_mode, template, engine)
+    with new_pool as pool:
+        return render_images(pool, step, html_list, file_name, image_dir, on_preview, blurred_step, post_workers, output,
+                             page_cache, manifest, on_image)
+
+def render_images(pool, step, html_list, file_name, image_dir, on_preview=None, blurred_step=None, post_workers=POST_WORKERS,
+                  output=None, page_cache=None, manifest=None, on_image=None):
+    if post_workers > 0:
+        log(f"[Pipeline] Post-processing pages on {post_workers} threads")
+        with ThreadPoolExecutor(max_workers=post_workers, thread_name_prefix="post") as executor:
+            post = (executor, threading.BoundedSemaphore(POST_QUEUE_SIZE))
+            return render_images_staged(pool, step, html_list, file_name, image_dir, on_preview, blurred_step, post, output,
+                                        page_cache, manifest, on_image)
+    return render_images_staged(pool, step, html_list, file_name, image_dir, on_preview, blurred_step, None, output, page_cache,
+                                manifest, on_image)
+
+def finished_stats(future):
+    """Encode stats of a render future that has completed successfully (through post-processing), else None."""
+    if not future.done() or future.cancelled() or future.exception() is not None:
+        return None
+    stats = future.result()
+    return finished_stats(stats) if isinstance(stats, Future) else stats
+
+def render_images_staged(pool, step, html_list, file_name, image_dir, on_preview, blurred_step, post, output, page_cache=None,
+                         manifest=None, on_image=None):
+    created_images = []
+    extension = IMAGE_FORMATS[(output or {}).get("format", IMAGE_FORMAT)][1]
+    
+    if pool.workers > 1:
+        log(f"[Pipeline] Rendering {len(html_list)} pages with {pool.workers} workers")
+
+    # Blurred pages use blurred_step, or the normal step with finish told to blur
+    blur_step = blurred_step or (step[0], functools.partial(step[1], apply_blur=True))
+
+    pending = []
+    for global_image_index, html_page in enumerate(html_list):
+        sheet_output_dir = os.path.join(image_dir, file_name, html_page["sheet"])
+        os.makedirs(sheet_output_dir, exist_ok=True)
+
+        img_path = os.path.join(sheet_output_dir, f"{html_page['name']}{extension}")
         
-        for type_label, html_path, sheet_name in html_list:
-            sheet_output_dir = os.path.join(image_dir, file_name, sheet_name)
-            os.makedirs(sheet_output_dir, exist_ok=True)
+        should_blur = global_image_index >= FREE_PREVIEW_IMAGES
+        manifest_key = manifest.key(html_page, should_blur) if manifest is not None else None
+        cache_key = page_cache.key(html_page, should_blur) if page_cache is not None else None
+        done = manifest.fetch(manifest_key, img_path) if manifest_key is not None else None
+        cached = None
+        if done is None and cache_key is not None:
+            cached = page_cache.fetch(cache_key, img_path)
+        if done is not None or cached is not None:
+            future = Future()
+            future.set_result(done or cached)
+        else:
+            page_step = blur_step if should_blur else step
+            future = pool.submit(run_render_step, page_step, html_page, img_path, post, output)
+        pending.append((
+            future, html_page, img_path, should_blur,
+            cache_key if done is None and cached is None else None,
+            manifest_key if done is None else None
+        ))
 
-            img_filename = os.path.basename(html_path).replace(".html", ".png")
-            img_path = os.path.join(sheet_output_dir, img_filename)
-            
-            page.goto(f"file://{os.path.abspath(html_path)}")
-            page.screenshot(path=img_path, full_page=False)
-            
-            should_blur = global_image_index >= FREE_PREVIEW_IMAGES
-            add_watermark_to_image(img_path, apply_blur=should_blur)
+    if manifest is not None and manifest.resumed:
+        log(f"[Resume] {manifest.resumed} of {len(pending)} pages kept from the previous run")
+    if page_cache is not None:
+        log(f"[Cache] {page_cache.hits} of {len(pending)} pages reused from {page_cache.directory}")
+
+    # Collect in submission order so numbering and blur flags match the page order
+    try:
+        for global_image_index, (future, html_page, img_path, should_blur, cache_key, manifest_key) in enumerate(pending):
+            stats = future.result()
+            if isinstance(stats, Future):
+                stats = stats.result()
+            if cache_key is not None:
+                page_cache.store(cache_key, img_path)
+            if manifest_key is not None:
+                manifest.record(manifest_key, img_path, stats)
             
             if should_blur:
                 log(f"[Preview] Image {global_image_index + 1} blurred (after {FREE_PREVIEW_IMAGES} free previews)")
             
             created_images.append({
                 "type": "page",
-                "sheet": sheet_name,
-                "page": int(type_label.replace("PAGE_", "")) if "PAGE_" in type_label else 1,
+                "sheet": html_page["sheet"],
+                "page": html_page["page"],
                 "path": img_path,
-                "isBlurred": should_blur
+                "isBlurred": should_blur,
+                "bytes": stats["bytes"],
+                "encodeMs": stats["encodeMs"]
             })
-            
-            global_image_index += 1
-
-        browser.close()
+            if on_image is not None:
+                on_image(created_images[-1], global_image_index, len(pending))
+            if on_preview is not None and len(created_images) == min(FREE_PREVIEW_IMAGES, len(pending)):
+                on_preview(list(created_images))
+    except Exception:
+        for future, _, _, _, _, _ in pending:
+            future.cancel()
+        # Pages that finished after the one that failed can still be resumed
+        if manifest is not None:
+            for future, _, img_path, _, _, manifest_key in pending[len(created_images) + 1:]:
+                stats = finished_stats(future)
+                if manifest_key is not None and stats is not None:
+                    manifest.record(manifest_key, img_path, stats)
+        raise
     
     log(f"[Summary] Created {len(created_images)} images, {min(FREE_PREVIEW_IMAGES, len(created_images))} clear, {max(0, len(created_images) - FREE_PREVIEW_IMAGES)} blurred")
+    if created_images:
+        total_bytes = sum(image["bytes"] for image in created_images)
+        total_ms = sum(image["encodeMs"] for image in created_images)
+        log(f"[Summary] {total_bytes / 1048576:.1f} MB, {total_bytes // len(created_images)} bytes and {total_ms / len(created_images):.0f} ms encoding per image")
     return created_images
 
+def image_event(image, index, total):
+    """The --progress event for a finished page image, with the SHA-256 of the file."""
+    with open(image["path"], "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "event": "image",
+        "index": index,
+        "total": total,
+        "path": image["path"],
+        "sheet": image["sheet"],
+        "page": image["page"],
+        "isBlurred": image["isBlurred"],
+        "bytes": image["bytes"],
+        "sha256": digest
+    }
+
 def cleanup_htmls(html_list):
-    for _, path, _ in html_list:
-        if os.path.exists(path):
-            os.remove(path)
+    for html_page in html_list:
+        for path in (html_page["html_path"], html_page["context_path"]):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+def split_workbook_parts(all_sheets, part_size):
+    """
+    Split parsed sheets the way runner.ts splitExcelFile does: the first row of each sheet
+    is its header, data rows fill parts of part_size rows in sheet order, and each part
+    repeats the header of every sheet it contains. Sheets without data rows are left out.
+    Returns one {sheet_name: DataFrame} per part.
+    """
+    parts = [{}]
+    row_count = 0
+    for sheet_name, df in all_sheets.items():
+        if len(df) < 2:
+            continue
+        header, rows = df.iloc[:1], df.iloc[1:]
+        start = 0
+        while start < len(rows):
+            if row_count >= part_size:
+                parts.append({})
+                row_count = 0
+            chunk = rows.iloc[start:start + part_size - row_count]
+            start += len(chunk)
+            row_count += len(chunk)
+            part = parts[-1]
+            part[sheet_name] = pd.concat([part.get(sheet_name, header), chunk])
+    return [{sheet_name: as_part_sheet(df) for sheet_name, df in part.items()} for part in parts if part]
+
+def as_part_sheet(df):
+    """
+    A slice of a sheet typed the way read_excel types the part file it would have been
+    written to: rows renumbered, whole numbers as ints, dtypes (including numeric-looking
+    text columns) inferred from the slice alone and trailing empty columns dropped.
+    """
+    rows = [
+        [int(value) if isinstance(value, float) and value.is_integer() else value for value in row]
+        for row in df.to_numpy(dtype=object).tolist()
+    ]
+    part_df = pd.DataFrame(rows)
+    for col in part_df.columns:
+        if pd.api.types.is_numeric_dtype(part_df[col]):
+            continue
+        try:
+            numeric = pd.to_numeric(part_df[col])
+        except (ValueError, TypeError):
+            continue
+        if numeric.dtype.kind in 'if':
+            part_df[col] = numeric
+    while len(part_df.columns) > 1 and part_df[part_df.columns[-1]].isna().all():
+        part_df = part_df.iloc[:, :-1]
+    return part_df
 
-def process_excel_file(excel_path, output_dir, template_path):
+def process_excel_parts(excel_path, output_dir, template_path, part_size, pool=None, sheet_names=None, start_row=1, end_row=None,
+                        **options):
+    """
+    Batch mode: parse the workbook once, split it into parts of part_size data rows and
+    process every part into output_dir/part{N} (file name {name}_part{N}) on one render pool.
+    A workbook that fits in one part is processed as a whole into output_dir.
+    Returns [(output_dir, result)] per part.
+    """
     file_name = os.path.splitext(os.path.basename(excel_path))[0]
-    
-    html_dir = os.path.join(output_dir, "temp_html")
-    image_dir = output_dir
-    
-    os.makedirs(html_dir, exist_ok=True)
-    os.makedirs(image_dir, exist_ok=True)
-    
+    if options.get("stream"):
+        log(f"[Pipeline] Batch mode splits the parsed workbook; --stream is ignored")
     try:
-        all_sheets = pd.read_excel(excel_path, sheet_name=None, header=None)
+        all_sheets = read_workbook(excel_path, sheet_names, start_row, end_row)
     except Exception as e:
-        return {
+        return [(output_dir, {
             "success": False,
             "error": f"Failed to read Excel file: {e}"
-        }
+        })]
+
+    parts = split_workbook_parts(all_sheets, part_size)
+    range_options = {"sheet_names": sheet_names, "start_row": start_row, "end_row": end_row}
+    if len(parts) <= 1:
+        return [(output_dir, process_excel_file(
+            excel_path, output_dir, template_path, pool=pool, sheets=all_sheets, **range_options, **options
+        ))]
+    log(f"[Pipeline] Splitting {file_name} into {len(parts)} parts of up to {part_size} rows")
+
+    def process_parts(pool):
+        part_results = []
+        for part_number, part_sheets in enumerate(parts, start=1):
+            log(f"[Pipeline] Part {part_number}/{len(parts)}")
+            part_dir = os.path.join(output_dir, f"part{part_number}")
+            part_results.append((part_dir, process_excel_file(
+                excel_path, part_dir, template_path, pool=pool,
+                sheets=part_sheets, file_name=f"{file_name}_part{part_number}", **range_options, **options
+            )))
+        return part_results
+
+    if pool is not None:
+        return process_parts(pool)
+    new_pool = make_render_pool(
+        options.get("render_workers", RENDER_WORKERS), options.get("render_mode", RENDER_MODE),
+        load_template(template_path), options.get("engine", RENDER_ENGINE)
+    )[0]
+    with new_pool as pool:
+        return process_parts(pool)
 
-    log(f"[Pipeline] Processing: {file_name}")
+def load_template(template_path):
+    """The compiled Jinja template at template_path, reused until the file changes."""
+    key = (os.path.abspath(template_path), os.path.getmtime(template_path))
+    template = _template_cache.get(key)
+    if template is None:
+        template_dir = os.path.dirname(template_path)
+        template_name = os.path.basename(template_path)
+        env = Environment(loader=FileSystemLoader(template_dir))
+        template = env.get_template(template_name)
+        _template_cache[key] = template
+    return template
+
+def process_excel_file(excel_path, output_dir, template_path, stream=False, render_workers=RENDER_WORKERS, in_memory=False,
+                       render_mode=RENDER_MODE, engine=RENDER_ENGINE, pool=None, sheets=None, file_name=None,
+                       sheet_names=None, start_row=1, end_row=None, preview_first=False, emit=None,
+                       blurred_pages=BLURRED_PAGE_MODE, post_workers=POST_WORKERS, image_format=IMAGE_FORMAT,
+                       image_quality=IMAGE_QUALITY, compress_level=PNG_COMPRESS_LEVEL, palette_colors=PALETTE_COLORS,
+                       page_cache=None, result_cache=None, resume=False, progress=False, uploader=None):
+    """
+    Turn a workbook into page images and return the result dict. sheets ({name: DataFrame})
+    and file_name let a caller pass an already parsed workbook, e.g. one part of a split.
+    sheet_names, start_row and end_row restrict what is read to those sheets and Excel rows.
+    preview_first writes pipeline_preview.json (the clear previews only) as soon as they
+    are rendered and reports it through emit({"event": "preview", ...}).
+    blurred_pages picks how pages past the free previews are rendered (BLURRED_PAGE_MODES).
+    post_workers threads watermark and encode pages while the next ones are captured.
+    image_format (IMAGE_FORMATS), image_quality and compress_level pick the output encoder;
+    palette_colors > 0 quantizes PNG pages to a palette shared across the run.
+    page_cache is a directory of finished pages by content hash (PageCache); pages found
+    there are copied instead of rendered, and newly rendered ones are added.
+    result_cache is a directory of finished runs by workbook fingerprint (ResultCache); a
+    workbook whose cells were processed before gets that run's images and result, renamed.
+    Finished pages are listed in output_dir/PROGRESS_MANIFEST as they complete; resume keeps
+    the pages an interrupted run already finished there instead of rendering them again.
+    progress reports each step through emit({"event": "stage", ...}) and each finished image
+    through emit({"event": "image", ...}) (see image_event), as they happen.
+    uploader (an Uploader) uploads each image as soon as it is finished; the result then
+    gives every image its "url" and the upload stats.
+    """
+    if file_name is None:
+        file_name = os.path.splitext(os.path.basename(excel_path))[0]
     
-    # Step 0a: Pre-process - Remove header rows containing Facebook URL
-    log(f"[Pipeline] Step 0a: Checking for Facebook URL in first 30 rows...")
-    for sheet_name in all_sheets:
-        all_sheets[sheet_name] = remove_header_rows_with_facebook_url(all_sheets[sheet_name])
+    # Renderers that fill the cells themselves never need the page HTML
+    render_html = engine == "chromium" and render_mode == "navigate"
+    keep_page_data = not render_html or blurred_pages == "downscaled"
+
+    if stream and sheets is not None:
+        stream = False
+    elif stream and not excel_path.lower().endswith(STREAM_EXTENSIONS):
+        log(f"[Pipeline] Streaming not supported for {os.path.splitext(excel_path)[1]}, loading workbook into memory")
+        stream = False
+
+    # In-memory mode keeps each page's HTML in its record and never touches temp_html;
+    # streaming keeps the page context of renderers that skip the HTML there as well
+    html_dir = None if in_memory or not (render_html or stream) else os.path.join(output_dir, "temp_html")
+    image_dir = output_dir
     
-    # Step 0b: Pre-process - Remove cell contents containing restricted keywords
-    log(f"[Pipeline] Step 0b: Cleaning cells with restricted keywords...")
-    for sheet_name in all_sheets:
-        all_sheets[sheet_name] = clean_dataframe_cells(all_sheets[sheet_name])
-
-    template_dir = os.path.dirname(template_path)
-    template_name = os.path.basename(template_path)
-    env = Environment(loader=FileSystemLoader(template_dir))
-    template = env.get_template(template_name)
-
-    def generate_all_htmls():
-        total_htmls = []
-        for sheet_name, df in all_sheets.items():
-            sheet_htmls = generate_html_for_sheet(df, file_name, sheet_name, template, html_dir)
-            total_htmls.extend(sheet_htmls)
-        return total_htmls
+    if html_dir:
+        os.makedirs(html_dir, exist_ok=True)
+    os.makedirs(image_dir, exist_ok=True)
+
+    template = load_template(template_path)
+    if sheet_names or start_row > 1 or end_row is not None:
+        log(f"[Pipeline] Reading rows {start_row}-{end_row or 'end'} of {', '.join(sheet_names) if sheet_names else 'every sheet'}")
+    _remove_cell_cache.reset_stats()
+    _mask_cell_cache.reset_stats()
+
+    def stage(name, **fields):
+        if progress and emit is not None:
+            emit({"event": "stage", "stage": name, "fileName": file_name, "outputDir": image_dir, **fields})
+
+    def on_image(image, index, total):
+        if uploader is not None:
+            uploader.submit(image["path"])
+        if progress and emit is not None:
+            emit({**image_event(image, index, total), "fileName": file_name, "outputDir": image_dir})
+
+    output_settings = {"format": image_format, "quality": image_quality, "compress_level": compress_level,
+                       "palette_colors": palette_colors}
+    results = ResultCache(result_cache) if result_cache else None
+    fingerprint = None
+
+    def reuse_result():
+        cached_result = results.load(fingerprint, file_name, image_dir)
+        if cached_result is not None:
+            log(f"[Cache] Workbook {fingerprint[:12]} was processed before; reusing its {cached_result['totalImages']} images")
+            if html_dir and os.path.exists(html_dir):
+                shutil.rmtree(html_dir, ignore_errors=True)
+            stage("render", total=cached_result["totalImages"])
+            for index, image in enumerate(cached_result["images"]):
+                on_image(image, index, cached_result["totalImages"])
+            if uploader is not None:
+                cached_result["upload"] = uploader.wait(cached_result["images"])
+        return cached_result
+
+    if results is not None:
+        fingerprint_settings = result_cache_settings(
+            page_cache_settings(template_path, engine, render_mode, blurred_pages, output_settings), start_row
+        )
+
+    if stream:
+        log(f"[Pipeline] Processing: {file_name} (streaming, window: {STREAM_WINDOW_PAGES * ROWS_PER_PAGE} rows)")
+
+        def generate_all_htmls():
+            total_htmls = []
+            for sheet_name, open_rows in iter_workbook_sheets(excel_path, sheet_names, start_row, end_row):
+                width, numeric_columns = scan_sheet_layout(open_rows(), first_row=start_row)
+                next_page = 1
+                for block in stream_sheet_blocks(open_rows(), width, numeric_columns, first_row=start_row):
+                    block_htmls = generate_html_for_sheet(
+                        block, file_name, sheet_name, template, html_dir,
+                        first_page=next_page, keep_page_data=keep_page_data, render_html=render_html
+                    )
+                    next_page += len(block_htmls)
+                    total_htmls.extend(block_htmls)
+            return total_htmls
+
+        stage("read")
+        try:
+            if results is not None:
+                fingerprint = stream_workbook_fingerprint(excel_path, fingerprint_settings, sheet_names, start_row, end_row)
+                cached_result = reuse_result()
+                if cached_result is not None:
+                    return cached_result
+            log(f"[Pipeline] Step 0-1: Streaming rows (header cleanup, keyword cleaning, HTML)...")
+            all_html_files = generate_all_htmls()
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Failed to read Excel file: {e}"
+            }
+    else:
+        stage("read")
+        try:
+            all_sheets = dict(sheets) if sheets is not None else read_workbook(excel_path, sheet_names, start_row, end_row)
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Failed to read Excel file: {e}"
+            }
+
+        log(f"[Pipeline] Processing: {file_name}")
+
+        if results is not None:
+            fingerprint = workbook_fingerprint(all_sheets, fingerprint_settings)
+            cached_result = reuse_result()
+            if cached_result is not None:
+                return cached_result
+        
+        stage("clean")
+        # Step 0a: Pre-process - Remove header rows containing Facebook URL
+        # (a row range that starts below row 1 has no header rows to remove)
+        if start_row == 1:
+            log(f"[Pipeline] Step 0a: Checking for Facebook URL in first 30 rows...")
+            for sheet_name in all_sheets:
+                all_sheets[sheet_name] = remove_header_rows_with_facebook_url(all_sheets[sheet_name])
+        
+        # Step 0b: Pre-process - Remove cell contents containing restricted keywords
+        log(f"[Pipeline] Step 0b: Cleaning cells with restricted keywords...")
+        for sheet_name in all_sheets:
+            all_sheets[sheet_name] = clean_dataframe_cells(all_sheets[sheet_name])
+
+        def generate_all_htmls():
+            total_htmls = []
+            for sheet_name, df in all_sheets.items():
+                sheet_htmls = generate_html_for_sheet(
+                    df, file_name, sheet_name, template, html_dir,
+                    keep_page_data=keep_page_data, render_html=render_html
+                )
+                total_htmls.extend(sheet_htmls)
+            return total_htmls
+
+        log(f"[Pipeline] Step 1: Generating HTML...")
+        stage("html")
+        all_html_files = generate_all_htmls()
 
-    log(f"[Pipeline] Step 1: Generating HTML...")
-    all_html_files = generate_all_htmls()
     if not all_html_files:
         return {
             "success": False,
@@ -449,13 +2117,10 @@ def process_excel_file(excel_path, output_dir, template_path):
         }
 
     log(f"[Pipeline] Step 2: Security check (tolerance: {MAX_LEAK_TOLERANCE})...")
-    total_leaks = 0
-    all_leak_details = []
-    
-    for _, html_path, _ in all_html_files:
-        count, details = check_html_leakage_count(html_path, file_name)
-        total_leaks += count
-        all_leak_details.extend(details)
+    stage("security", pages=len(all_html_files))
+    total_leaks, all_leak_details = count_page_leaks(all_html_files)
+    for leak in all_leak_details[:LEAK_LOG_LIMIT]:
+        log(f"[Pipeline] Leak: {leak['sheet']}!{leak['column']}{leak['row']}: {leak['value']}")
     
     should_retry = False
     if total_leaks > MAX_LEAK_TOLERANCE:
@@ -467,78 +2132,349 @@ def process_excel_file(excel_path, output_dir, template_path):
         log(f"[Pipeline] Excellent: No leaks detected.")
 
     if should_retry:
-        cleanup_htmls(all_html_files)
-        all_html_files = generate_all_htmls()
-        total_leaks = 0
-        all_leak_details = []
-        for _, html_path, _ in all_html_files:
-            count, details = check_html_leakage_count(html_path, file_name)
-            total_leaks += count
-            all_leak_details.extend(details)
+        leaking_pages = [html_page for html_page in all_html_files if html_page["leaks"]]
+        log(f"[Pipeline] Re-masking leaking cells on {len(leaking_pages)} page(s) with the strict profile...")
+        for html_page in leaking_pages:
+            remask_page_strict(html_page, template, file_name)
+        total_leaks, all_leak_details = count_page_leaks(all_html_files)
+        log(f"[Pipeline] {total_leaks} leaks remaining after retry.")
 
     if total_leaks > MAX_LEAK_TOLERANCE:
         cleanup_htmls(all_html_files)
         return {
             "success": False,
-            "error": f"Security check failed: {total_leaks} leaks detected after retry"
+            "error": f"Security check failed: {total_leaks} leaks detected after retry",
+            "leaks": all_leak_details
         }
 
+    on_preview = None
+    if preview_first:
+        def on_preview(preview_images):
+            preview = {
+                "success": True,
+                "partial": True,
+                "fileName": file_name,
+                "totalImages": len(preview_images),
+                "expectedImages": len(all_html_files),
+                "coverPhoto": preview_images[0]["path"] if preview_images else None,
+                "images": preview_images,
+                "outputDir": image_dir
+            }
+            preview_json_path = os.path.join(image_dir, "pipeline_preview.json")
+            with open(preview_json_path, 'w', encoding='utf-8') as f:
+                json.dump(preview, f, ensure_ascii=False, indent=2)
+            log(f"[Preview] {len(preview_images)} preview images ready, {len(all_html_files) - len(preview_images)} pages left")
+            if emit is not None:
+                emit({"event": "preview", "outputFile": preview_json_path})
+
+    quantizer = None
+    if palette_colors and image_format == "png":
+        quantizer = PaletteQuantizer(palette_colors)
+    elif palette_colors:
+        log(f"[Pipeline] Palette quantization only applies to png output; ignored for {image_format}")
+
+    output = {"format": image_format, "quality": image_quality, "compress_level": compress_level, "quantizer": quantizer}
+    page_settings = page_cache_settings(template_path, engine, render_mode, blurred_pages, output_settings)
+    cache = PageCache(page_cache, page_settings) if page_cache else None
+    manifest = ProgressManifest(image_dir, page_settings, resume=resume)
+
     log(f"[Pipeline] Step 3: Creating images...")
+    stage("render", total=len(all_html_files))
     try:
-        created_images = create_images_from_list(all_html_files, file_name, image_dir)
+        created_images = create_images_from_list(
+            all_html_files, file_name, image_dir,
+            render_workers=render_workers,
+            render_mode=render_mode,
+            template=template,
+            engine=engine,
+            pool=pool,
+            on_preview=on_preview,
+            blurred_pages=blurred_pages,
+            post_workers=post_workers,
+            output=output,
+            page_cache=cache,
+            manifest=manifest,
+            on_image=on_image
+        )
         cleanup_htmls(all_html_files)
         
-        if os.path.exists(html_dir):
+        if html_dir and os.path.exists(html_dir):
             try:
                 shutil.rmtree(html_dir)
             except:
                 pass
         
         cover_photo = created_images[0]["path"] if created_images else None
+        cell_cache = {"remove": _remove_cell_cache.stats(), "mask": _mask_cell_cache.stats()}
+        log(f"[Pipeline] Cell cache hit rate: remove {cell_cache['remove']['hitRate']:.1%}, mask {cell_cache['mask']['hitRate']:.1%}")
+        palette = quantizer.stats() if quantizer is not None else None
+        if palette is not None:
+            log(f"[Pipeline] Palette: {palette['colors']} colors, shared by {palette['shared']} pages, {palette['adaptive']} built")
         
-        return {
+        result = {
             "success": True,
             "fileName": file_name,
             "totalImages": len(created_images),
             "coverPhoto": cover_photo,
             "images": created_images,
-            "outputDir": image_dir
+            "outputDir": image_dir,
+            "imageFormat": image_format,
+            "imageBytes": sum(image["bytes"] for image in created_images),
+            "encodeMs": round(sum(image["encodeMs"] for image in created_images), 1),
+            "palette": palette,
+            "pageCache": cache.stats() if cache is not None else None,
+            "resumedPages": manifest.resumed,
+            "leakCount": total_leaks,
+            "leaks": all_leak_details,
+            "cellCache": cell_cache
         }
+        if results is not None:
+            results.store(fingerprint, result)
+            result["resultCache"] = {"hit": False, "fingerprint": fingerprint}
+        if uploader is not None:
+            result["upload"] = uploader.wait(created_images)
+        return result
     except Exception as e:
         cleanup_htmls(all_html_files)
         return {
             "success": False,
             "error": f"Failed to create images: {e}"
         }
+    finally:
+        manifest.close()
 
-def main():
-    if len(sys.argv) < 4:
+class PipelineArgumentParser(argparse.ArgumentParser):
+    """Report usage errors as a JSON result, like every other failure of this script."""
+
+    def error(self, message):
         result = {
             "success": False,
-            "error": "Usage: python excel_to_png.py <excel_path> <output_dir> <template_path>"
+            "error": f"Usage: python excel_to_png.py <excel_path> <output_dir> <template_path> [options] ({message})"
         }
         print(json.dumps(result))
         sys.exit(1)
-    
-    excel_path = sys.argv[1]
-    output_dir = sys.argv[2]
-    template_path = sys.argv[3]
-    
+
+def parse_args(argv):
+    parser = PipelineArgumentParser(prog="excel_to_png.py", description="Render Excel sheets into watermarked PNG pages.")
+    parser.add_argument("excel_path", nargs="?")
+    parser.add_argument("output_dir", nargs="?")
+    parser.add_argument("template_path", nargs="?")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the workbook row by row instead of loading every sheet into memory (.xlsx/.xlsm/.xls)")
+    parser.add_argument("--render-workers", type=int, default=RENDER_WORKERS,
+                        help="Number of browsers rendering pages in parallel (default: %(default)s)")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Keep rendered HTML in memory and load it with set_content instead of temp_html files")
+    parser.add_argument("--render-mode", choices=RENDER_MODES, default=RENDER_MODE,
+                        help="navigate: load each page as a document; template: load the template once per browser and update only the cells")
+    parser.add_argument("--engine", choices=RENDER_ENGINES, default=RENDER_ENGINE,
+                        help="chromium: screenshot the HTML template; pillow: draw the table directly without a browser")
+    parser.add_argument("--part-size", type=int, default=None,
+                        help="Split the workbook like runner.ts does, into parts of this many data rows, and write part{N}/pipeline_result.json for each")
+    parser.add_argument("--sheets", type=lambda value: [name.strip() for name in value.split(",") if name.strip()], default=None,
+                        help="Comma-separated sheet names to process (default: every sheet)")
+    parser.add_argument("--start-row", type=int, default=1,
+                        help="First Excel row to read, 1-based (default: %(default)s)")
+    parser.add_argument("--end-row", type=int, default=None,
+                        help="Last Excel row to read, inclusive (default: the end of each sheet)")
+    parser.add_argument("--preview-first", action="store_true",
+                        help="Write pipeline_preview.json and print a preview event line as soon as the clear preview pages are rendered")
+    parser.add_argument("--blurred-pages", choices=BLURRED_PAGE_MODES, default=BLURRED_PAGE_MODE,
+                        help="full: render blurred pages like clear ones; downscaled: draw them small with Pillow, blur and upscale")
+    parser.add_argument("--post-workers", type=int, default=POST_WORKERS,
+                        help="Threads that blur, watermark and encode pages while the next ones render; 0 does it on the render workers (default: %(default)s)")
+    parser.add_argument("--image-format", choices=IMAGE_FORMATS, default=IMAGE_FORMAT,
+                        help="png or webp: lossless; webp-lossy or jpeg: lossy at --image-quality (default: %(default)s)")
+    parser.add_argument("--image-quality", type=int, default=IMAGE_QUALITY,
+                        help="Quality 1-100 for webp-lossy and jpeg (default: %(default)s)")
+    parser.add_argument("--compress-level", type=int, default=PNG_COMPRESS_LEVEL,
+                        help="PNG zlib level 0-9; higher is smaller but slower (default: %(default)s)")
+    parser.add_argument("--palette-colors", type=int, default=PALETTE_COLORS,
+                        help="Quantize PNG pages to this many colors (2-256) with a palette shared across the run; 0 keeps RGB (default: %(default)s)")
+    parser.add_argument("--page-cache", default=None, metavar="DIR",
+                        help="Directory of finished pages by content hash; unchanged pages are copied from it instead of rendered")
+    parser.add_argument("--result-cache", default=None, metavar="DIR",
+                        help="Directory of finished runs by workbook fingerprint; a workbook with the same cells reuses the stored images and result")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"Keep the pages an interrupted run already finished in output_dir (listed in {PROGRESS_MANIFEST}) instead of rendering them again")
+    parser.add_argument("--progress", action="store_true",
+                        help="Print a JSON event line for each pipeline step and each finished image (path, sheet, page, blur flag, size, SHA-256) before the summary")
+    parser.add_argument("--upload-to", default=None, metavar="URL",
+                        help="Upload each image as it is finished to s3://bucket/prefix (DO_ENDPOINT, DO_ACCESS_KEY, DO_SECRET_KEY) or file:///directory")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS,
+                        help="Concurrent uploads for --upload-to (default: %(default)s)")
+    parser.add_argument("--serve", action="store_true",
+                        help="Stay running and take one JSON job per line on stdin; the other options become per-job defaults")
+    args = parser.parse_args(argv)
+    if args.part_size is not None and args.part_size < 1:
+        parser.error("--part-size must be at least 1")
+    if not 1 <= args.image_quality <= 100:
+        parser.error("--image-quality must be between 1 and 100")
+    if not 0 <= args.compress_level <= 9:
+        parser.error("--compress-level must be between 0 and 9")
+    if args.palette_colors != 0 and not 2 <= args.palette_colors <= 256:
+        parser.error("--palette-colors must be 0 or between 2 and 256")
+    if args.upload_to is not None and urllib.parse.urlsplit(args.upload_to).scheme not in UPLOAD_SCHEMES:
+        parser.error("--upload-to must be an s3:// or file:// URL")
+    if args.upload_workers < 1:
+        parser.error("--upload-workers must be at least 1")
+    if args.post_workers < 0:
+        parser.error("--post-workers must not be negative")
+    if args.start_row < 1 or (args.end_row is not None and args.end_row < args.start_row):
+        parser.error("--start-row must be at least 1 and --end-row not before it")
+    if not args.serve and None in (args.excel_path, args.output_dir, args.template_path):
+        parser.error("excel_path, output_dir and template_path are required")
+    return args
+
+def run_job(excel_path, output_dir, template_path, part_size=None, upload_to=None, upload_workers=UPLOAD_WORKERS, **options):
+    """
+    Process one workbook, write pipeline_result.json to output_dir (to every part directory
+    when part_size is set) and return the summary printed on stdout. upload_to adds the
+    upload stage, with one Uploader shared by every part.
+    """
     if not os.path.exists(excel_path):
-        result = {
+        return {
             "success": False,
             "error": f"File not found: {excel_path}"
         }
-        print(json.dumps(result))
-        sys.exit(1)
     
-    result = process_excel_file(excel_path, output_dir, template_path)
+    uploader = None
+    if upload_to:
+        try:
+            uploader = Uploader(upload_to, output_dir, upload_workers)
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Failed to set up uploads: {e}"
+            }
+    try:
+        if part_size:
+            part_results = process_excel_parts(excel_path, output_dir, template_path, part_size, uploader=uploader, **options)
+        else:
+            part_results = [(output_dir, process_excel_file(excel_path, output_dir, template_path, uploader=uploader, **options))]
+    finally:
+        if uploader is not None:
+            uploader.close()
+    
+    output_files = []
+    for result_dir, result in part_results:
+        os.makedirs(result_dir, exist_ok=True)
+        output_json_path = os.path.join(result_dir, "pipeline_result.json")
+        with open(output_json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        output_files.append(output_json_path)
     
-    output_json_path = os.path.join(output_dir, "pipeline_result.json")
-    with open(output_json_path, 'w', encoding='utf-8') as f:
-        json.dump(result, f, ensure_ascii=False, indent=2)
+    if part_size:
+        return {"success": True, "outputFiles": output_files}
+    return {"success": True, "outputFile": output_files[0]}
+
+def run_serve_job(job, defaults, pools, emit=None):
+    """Run one --serve job on a warm render pool for its engine, render mode and template."""
+    options = dict(defaults)
+    options.update((key, job[key]) for key in SERVE_JOB_OPTIONS if key in job)
+    if options["render_mode"] not in RENDER_MODES:
+        raise ValueError(f"unknown render_mode {options['render_mode']!r}")
+    if options["engine"] not in RENDER_ENGINES:
+        raise ValueError(f"unknown engine {options['engine']!r}")
+    if options["blurred_pages"] not in BLURRED_PAGE_MODES:
+        raise ValueError(f"unknown blurred_pages {options['blurred_pages']!r}")
+    if options["image_format"] not in IMAGE_FORMATS:
+        raise ValueError(f"unknown image_format {options['image_format']!r}")
+
+    # Refuse a missing workbook before a render pool (and its browsers) is started for it
+    if not os.path.exists(job["excel_path"]):
+        return {
+            "success": False,
+            "error": f"File not found: {job['excel_path']}"
+        }
+
+    template = load_template(job["template_path"]) if options["render_mode"] == "template" else None
+    pool_key = (options["engine"], options["render_mode"], options["render_workers"], template)
+    pool = pools.get(pool_key)
+    if pool is not None and pool.broken:
+        log(f"[Worker] Restarting render pool after a browser failure")
+        pool.close()
+        pool = None
+    if pool is None:
+        pool = make_render_pool(options["render_workers"], options["render_mode"], template, options["engine"])[0]
+        pool.start()
+        pools[pool_key] = pool
+
+    return run_job(job["excel_path"], job["output_dir"], job["template_path"], pool=pool, emit=emit, **options)
+
+def serve(defaults, input_stream=sys.stdin, output_stream=sys.stdout):
+    """
+    Worker mode. Each stdin line is a JSON job: {"id", "excel_path", "output_dir", "template_path"}
+    plus any of SERVE_JOB_OPTIONS. Each job is answered with one stdout line: the summary the
+    one-shot CLI prints, plus the job's id; events such as {"event": "preview"} come before
+    it with the same id. Browsers and templates stay loaded between jobs.
+    {"command": "shutdown"} or end of input stops the worker.
+    """
+    pools = {}
+
+    def write_line(message):
+        output_stream.write(json.dumps(message, ensure_ascii=False) + "\n")
+        output_stream.flush()
+
+    log("[Worker] Ready")
+    try:
+        for line in input_stream:
+            if not line.strip():
+                continue
+            job_id = None
+            try:
+                job = json.loads(line)
+                job_id = job.get("id")
+                if job.get("command") == "shutdown":
+                    break
+                emit = lambda event, job_id=job_id: write_line({"id": job_id, **event})
+                response = run_serve_job(job, defaults, pools, emit=emit)
+            except Exception as e:
+                response = {"success": False, "error": f"Job failed: {e}"}
+            write_line({"id": job_id, **response})
+    finally:
+        for pool in pools.values():
+            pool.close()
+    log("[Worker] Stopped")
+
+def main():
+    args = parse_args(sys.argv[1:])
+    options = {
+        "stream": args.stream,
+        "render_workers": args.render_workers,
+        "in_memory": args.in_memory,
+        "render_mode": args.render_mode,
+        "engine": args.engine,
+        "part_size": args.part_size,
+        "sheet_names": args.sheets,
+        "start_row": args.start_row,
+        "end_row": args.end_row,
+        "preview_first": args.preview_first,
+        "blurred_pages": args.blurred_pages,
+        "post_workers": args.post_workers,
+        "image_format": args.image_format,
+        "image_quality": args.image_quality,
+        "compress_level": args.compress_level,
+        "palette_colors": args.palette_colors,
+        "page_cache": args.page_cache,
+        "result_cache": args.result_cache,
+        "resume": args.resume,
+        "progress": args.progress,
+        "upload_to": args.upload_to,
+        "upload_workers": args.upload_workers
+    }
+    
+    if args.serve:
+        serve(options)
+        return
+    
+    emit = lambda event: print(json.dumps(event, ensure_ascii=False), flush=True)
+    response = run_job(args.excel_path, args.output_dir, args.template_path, emit=emit, **options)
+    if not response["success"]:
+        print(json.dumps(response))
+        sys.exit(1)
     
-    print(json.dumps({"success": True, "outputFile": output_json_path}, ensure_ascii=False))
+    print(json.dumps(response, ensure_ascii=False))
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,4 @@
-import { spawn } from "child_process";
+import { spawn, type ChildProcess } from "child_process";
 import path from "path";
 import fs from "fs/promises";
 // Thêm import createRequire để fallback nếu cần
@@ -265,8 +265,20 @@ export interface PipelineResult {
     page: number;
     path: string;
     isBlurred?: boolean;
+    bytes?: number;
+    encodeMs?: number;
   }>;
   outputDir?: string;
+  imageFormat?: string;
+  imageBytes?: number;
+  encodeMs?: number;
+  leakCount?: number;
+  leaks?: Array<{
+    sheet: string;
+    row: number;
+    column: string;
+    value: string;
+  }>;
   error?: string;
 }
 
@@ -487,7 +499,7 @@ async function uploadImagesToSpaces(
   
   for (let i = 0; i < images.length; i++) {
     const img = images[i];
-    const imgFileName = `${String(i + 1).padStart(3, '0')}_${img.sheet}_page${img.page}.png`;
+    const imgFileName = `${String(i + 1).padStart(3, '0')}_${img.sheet}_page${img.page}${path.extname(img.path) || '.png'}`;
     
     const result = await uploadToSpaces({
       localFilePath: img.path,
@@ -513,6 +525,136 @@ async function uploadImagesToSpaces(
   return { imageUrls, coverUrl };
 }
 
+function pipelineEnv(): NodeJS.ProcessEnv {
+  return {
+    ...process.env,
+    PLAYWRIGHT_BROWSERS_PATH: path.join(process.cwd(), '.cache', 'ms-playwright'),
+    LD_LIBRARY_PATH: `${process.env.LD_LIBRARY_PATH || ''}:/nix/store`,
+  };
+}
+
+// Opt-in: PIPELINE_WORKER=1 sends every job to one long-lived `excel_to_png.py --serve`
+// process (Python imports, template and browser stay warm) instead of spawning one per part.
+const USE_PIPELINE_WORKER = process.env.PIPELINE_WORKER === "1";
+
+interface PipelineWorkerResponse {
+  id: number | null;
+  event?: string;
+  success: boolean;
+  outputFile?: string;
+  error?: string;
+}
+
+interface PendingPipelineJob {
+  resolve: (response: PipelineWorkerResponse) => void;
+  onProgress?: (message: string) => void;
+}
+
+let pipelineWorker: ChildProcess | null = null;
+let nextPipelineJobId = 1;
+const pendingPipelineJobs = new Map<number, PendingPipelineJob>();
+
+function getPipelineWorker(scriptPath: string): ChildProcess {
+  if (pipelineWorker) {
+    return pipelineWorker;
+  }
+
+  const worker = spawn("python3", [scriptPath, "--serve"], { env: pipelineEnv() });
+  let buffer = "";
+
+  worker.stdout!.on("data", (data) => {
+    buffer += data.toString();
+    let newline = buffer.indexOf("\n");
+    while (newline >= 0) {
+      const line = buffer.slice(0, newline).trim();
+      buffer = buffer.slice(newline + 1);
+      newline = buffer.indexOf("\n");
+      if (!line) continue;
+      let response: PipelineWorkerResponse;
+      try {
+        response = JSON.parse(line);
+      } catch (error) {
+        console.error(`[Pipeline] Unreadable worker output: ${line.substring(0, 200)}`);
+        continue;
+      }
+      const job = response.id !== null ? pendingPipelineJobs.get(response.id) : undefined;
+      if (!job) continue;
+      if (job.onProgress) {
+        job.onProgress(line);
+      }
+      if (response.event) continue;
+      pendingPipelineJobs.delete(response.id!);
+      job.resolve(response);
+    }
+  });
+
+  worker.stderr!.on("data", (data) => {
+    const message = data.toString();
+    // The worker runs jobs one at a time, in the order they were sent: its log is the oldest pending job's
+    const currentJob = pendingPipelineJobs.values().next().value;
+    if (currentJob && currentJob.onProgress) {
+      currentJob.onProgress(`[ERROR] ${message}`);
+    } else {
+      console.log(message.trimEnd());
+    }
+  });
+
+  const failPendingJobs = (error: string) => {
+    if (pipelineWorker === worker) {
+      pipelineWorker = null;
+    }
+    pendingPipelineJobs.forEach((job) => job.resolve({ id: null, success: false, error }));
+    pendingPipelineJobs.clear();
+  };
+  worker.on("close", (code) => failPendingJobs(`Pipeline worker exited with code ${code}`));
+  worker.on("error", (error) => failPendingJobs(`Failed to start pipeline worker: ${error.message}`));
+  // Writing a job to a worker that has died fails here (EPIPE) instead of crashing the server
+  worker.stdin!.on("error", (error) => {
+    failPendingJobs(`Failed to send job to pipeline worker: ${error.message}`);
+    worker.kill();
+  });
+
+  pipelineWorker = worker;
+  return worker;
+}
+
+async function runOnPipelineWorker(
+  scriptPath: string,
+  excelFilePath: string,
+  outputDir: string,
+  templatePath: string,
+  onProgress?: (message: string) => void
+): Promise<PipelineResult> {
+  const response = await new Promise<PipelineWorkerResponse>((resolve) => {
+    const worker = getPipelineWorker(scriptPath);
+    const id = nextPipelineJobId++;
+    pendingPipelineJobs.set(id, { resolve, onProgress });
+    worker.stdin!.write(JSON.stringify({
+      id,
+      excel_path: excelFilePath,
+      output_dir: outputDir,
+      template_path: templatePath,
+    }) + "\n");
+  });
+
+  if (!response.success || !response.outputFile) {
+    return {
+      success: false,
+      error: response.error || "Pipeline worker did not return output file path",
+    };
+  }
+
+  try {
+    const resultData = await fs.readFile(response.outputFile, 'utf-8');
+    return JSON.parse(resultData);
+  } catch (error) {
+    return {
+      success: false,
+      error: `Failed to parse pipeline output. Error: ${error}`,
+    };
+  }
+}
+
 export interface PipelineOptions {
   excelFilePath: string;
   outputDir: string;
@@ -539,6 +681,10 @@ export async function runExcelToPngPipeline(options: PipelineOptions): Promise<P
   
   await fs.mkdir(outputDir, { recursive: true });
   
+  if (USE_PIPELINE_WORKER) {
+    return runOnPipelineWorker(scriptPath, excelFilePath, outputDir, templatePath, onProgress);
+  }
+  
   return new Promise((resolve) => {
     const pythonProcess = spawn("python3", [
       scriptPath,
@@ -546,11 +692,7 @@ export async function runExcelToPngPipeline(options: PipelineOptions): Promise<P
       outputDir,
       templatePath,
     ], {
-      env: {
-        ...process.env,
-        PLAYWRIGHT_BROWSERS_PATH: path.join(process.cwd(), '.cache', 'ms-playwright'),
-        LD_LIBRARY_PATH: `${process.env.LD_LIBRARY_PATH || ''}:/nix/store`,
-      }
+      env: pipelineEnv()
     });
     
     let stdout = "";
@@ -582,7 +724,8 @@ export async function runExcelToPngPipeline(options: PipelineOptions): Promise<P
       }
       
       try {
-        const stdoutJson = JSON.parse(stdout.trim());
+        // Event lines (e.g. --preview-first) may precede the summary, which is always last
+        const stdoutJson = JSON.parse(stdout.trim().split("\n").pop() || "");
         
         if (!stdoutJson.success || !stdoutJson.outputFile) {
           resolve({
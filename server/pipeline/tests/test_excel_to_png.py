@@ -0,0 +1,221 @@
+import datetime
+import json
+import os
+import sys
+
+import openpyxl
+import pytest
+
+import excel_to_png as pipeline
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "template.html")
+
+
+def write_workbook(path, rows, sheet_name="Sheet1"):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.title = sheet_name
+    for row in rows:
+        sheet.append(row)
+    book.save(path)
+    return str(path)
+
+
+def page_values(pages):
+    return [[cell["value"] for cell in row["cells"]] for page in pages for row in page["page_data"]]
+
+
+def stream_pages(excel_path):
+    """The page records process_excel_file builds in --stream mode."""
+    template = pipeline.load_template(TEMPLATE_PATH)
+    pages = []
+    for sheet_name, open_rows in pipeline.iter_workbook_sheets(excel_path):
+        width, numeric_columns = pipeline.scan_sheet_layout(open_rows())
+        sheet_pages = []
+        for block in pipeline.stream_sheet_blocks(open_rows(), width, numeric_columns):
+            sheet_pages.extend(pipeline.generate_html_for_sheet(
+                block, "book", sheet_name, template, None, first_page=len(sheet_pages) + 1, keep_page_data=True
+            ))
+        pages.extend(sheet_pages)
+    return pages
+
+
+def memory_pages(excel_path):
+    """The page records process_excel_file builds when it loads the whole workbook."""
+    template = pipeline.load_template(TEMPLATE_PATH)
+    pages = []
+    for sheet_name, df in pipeline.read_workbook(excel_path).items():
+        df = pipeline.clean_dataframe_cells(pipeline.remove_header_rows_with_facebook_url(df))
+        pages.extend(pipeline.generate_html_for_sheet(df, "book", sheet_name, template, None, keep_page_data=True))
+    return pages
+
+
+@pytest.fixture
+def small_stream_blocks(monkeypatch):
+    # one page per block, so a few dozen rows already span several blocks
+    monkeypatch.setattr(pipeline, "STREAM_WINDOW_PAGES", 1)
+
+
+def test_stream_keeps_blank_date_cells_blank_in_every_block(tmp_path, small_stream_blocks):
+    rows = [["Name", "Joined"]]
+    for i in range(35):
+        rows.append([f"user {i}", None if i % 3 else datetime.datetime(2024, 1, 1 + i % 28)])
+    excel_path = write_workbook(tmp_path / "dates.xlsx", rows)
+
+    pages = stream_pages(excel_path)
+
+    assert len(pages) == 4
+    dates = [row[1] for row in page_values(pages)[1:36]]
+    assert [date == "" for date in dates] == [bool(i % 3) for i in range(35)]
+
+
+BANNER_ROWS = [
+    ["Danh sach khach hang", None, None],
+    ["Name", "Amount", "Joined"],
+    [pipeline.FACEBOOK_URL_TO_CHECK, None, None],
+]
+
+
+def banner_workbook(path, count=25):
+    rows = list(BANNER_ROWS)
+    for i in range(count):
+        rows.append([
+            "xem tai trangvang" if i == 4 else f"user {i}",
+            None if i % 4 == 1 else 100 + i,
+            None if i % 5 == 2 else datetime.datetime(2024, 3, 1 + i % 28),
+        ])
+    return write_workbook(path, rows)
+
+
+def test_clean_dataframe_cells_matches_map_on_banner_workbook(tmp_path):
+    excel_path = banner_workbook(tmp_path / "banner.xlsx")
+    df = pipeline.remove_header_rows_with_facebook_url(pipeline.read_workbook(excel_path)["Sheet1"])
+
+    cleaned = pipeline.clean_dataframe_cells(df)
+    mapped = df.map(lambda value: "" if pipeline.should_remove_cell_content(value) else value)
+
+    assert cleaned.iloc[4, 0] == ""
+    assert cleaned.dtypes.tolist() == mapped.dtypes.tolist()
+    assert pipeline.stringify_cells(cleaned).equals(pipeline.stringify_cells(mapped))
+    assert pipeline.stringify_cells(cleaned).iloc[0, 1] == "100.0"
+
+
+def test_stream_matches_memory_on_banner_workbook(tmp_path, small_stream_blocks):
+    excel_path = banner_workbook(tmp_path / "banner.xlsx")
+
+    streamed, loaded = stream_pages(excel_path), memory_pages(excel_path)
+
+    assert page_values(streamed)[0][1] == "**0.*"
+    assert [page["html"] for page in streamed] == [page["html"] for page in loaded]
+
+
+def run_pillow(excel_path, output_dir, **options):
+    return pipeline.process_excel_file(
+        excel_path, str(output_dir), TEMPLATE_PATH, engine="pillow", render_mode="template", **options
+    )
+
+
+def customer_workbook(path, count=15):
+    return write_workbook(path, [["Name", "Phone"]] + [[f"user {i}", f"0901 {i:03d}"] for i in range(count)])
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("damage", ["corrupt_result", "missing_image"])
+def test_result_cache_treats_damaged_entry_as_miss(tmp_path, damage, stream):
+    excel_path = customer_workbook(tmp_path / "book.xlsx")
+    cache_dir = tmp_path / "results"
+    first = run_pillow(excel_path, tmp_path / "first", stream=stream, result_cache=str(cache_dir))
+    entry = cache_dir / first["resultCache"]["fingerprint"]
+    if damage == "corrupt_result":
+        (entry / "result.json").write_text('{"images": [', encoding="utf-8")
+    else:
+        (entry / "1.png").unlink()
+
+    second = run_pillow(excel_path, tmp_path / "second", stream=stream, result_cache=str(cache_dir))
+
+    assert second["success"] and second["resultCache"]["hit"] is False
+    assert second["totalImages"] == first["totalImages"] == 2
+    assert (entry / "1.png").exists()
+    third = run_pillow(excel_path, tmp_path / "third", stream=stream, result_cache=str(cache_dir))
+    assert third["resultCache"]["hit"] is True
+
+
+def test_stream_page_records_keep_their_context_on_disk(tmp_path, small_stream_blocks):
+    excel_path = customer_workbook(tmp_path / "book.xlsx", count=45)
+    template = pipeline.load_template(TEMPLATE_PATH)
+    html_dir = tmp_path / "temp_html"
+    html_dir.mkdir()
+    loaded = memory_pages(excel_path)
+
+    for sheet_name, open_rows in pipeline.iter_workbook_sheets(excel_path):
+        width, numeric_columns = pipeline.scan_sheet_layout(open_rows())
+        streamed = []
+        for block in pipeline.stream_sheet_blocks(open_rows(), width, numeric_columns):
+            streamed.extend(pipeline.generate_html_for_sheet(
+                block, "book", sheet_name, template, str(html_dir),
+                first_page=len(streamed) + 1, keep_page_data=True, render_html=False
+            ))
+
+    assert len(streamed) == len(loaded) == 5
+    for page, loaded_page in zip(streamed, loaded):
+        assert page["page_data"] is None and page["column_widths"] is None and page["html"] is None
+        context = pipeline.load_page_context(page)
+        assert context["page_data"] == loaded_page["page_data"]
+        assert context["column_widths"] == loaded_page["column_widths"]
+    pipeline.cleanup_htmls(streamed)
+    assert list(html_dir.iterdir()) == []
+
+
+def test_stream_pillow_run_matches_loaded_run(tmp_path):
+    excel_path = customer_workbook(tmp_path / "book.xlsx", count=25)
+
+    streamed = run_pillow(excel_path, tmp_path / "streamed", stream=True)
+    loaded = run_pillow(excel_path, tmp_path / "loaded")
+
+    assert streamed["success"] and streamed["totalImages"] == loaded["totalImages"] == 3
+    for a, b in zip(streamed["images"], loaded["images"]):
+        assert open(a["path"], "rb").read() == open(b["path"], "rb").read()
+    assert not os.path.exists(tmp_path / "streamed" / "temp_html")
+
+
+def test_s3_upload_without_boto3_names_the_extra(monkeypatch):
+    monkeypatch.setitem(sys.modules, "boto3", None)
+
+    with pytest.raises(RuntimeError, match="s3 extra"):
+        pipeline.open_object_store("s3://bucket/pages")
+
+
+def test_palette_quantizer_output_does_not_depend_on_page_order(tmp_path):
+    excel_path = customer_workbook(tmp_path / "book.xlsx", count=35)
+    images = [
+        pipeline.apply_watermark(pipeline.draw_table_image(page["column_widths"], page["page_data"]), apply_blur=n == 3)
+        for n, page in enumerate(memory_pages(excel_path))
+    ]
+
+    def quantize(order):
+        quantizer = pipeline.PaletteQuantizer(64)
+        quantized = {n: quantizer(images[n]) for n in order}
+        return [(quantized[n].tobytes(), quantized[n].getpalette()) for n in range(len(images))], quantizer.stats()
+
+    forward, forward_stats = quantize(range(len(images)))
+    backward, backward_stats = quantize(reversed(range(len(images))))
+
+    assert forward == backward
+    assert forward_stats == backward_stats and forward_stats["shared"] >= 3
+
+
+def test_resume_skips_malformed_manifest_entries(tmp_path):
+    excel_path = customer_workbook(tmp_path / "book.xlsx", count=25)
+    output_dir = tmp_path / "out"
+    first = run_pillow(excel_path, output_dir)
+    manifest = output_dir / pipeline.PROGRESS_MANIFEST
+    lines = manifest.read_text(encoding="utf-8").splitlines()
+    damaged = json.loads(lines[0])
+    del damaged["image"]
+    lines[0] = json.dumps(damaged)
+    manifest.write_text("\n".join(lines + ['[1, 2]', '42', '{"image": ["a"]}', '{"image": "x.png"}']) + "\n", encoding="utf-8")
+
+    resumed = run_pillow(excel_path, output_dir, resume=True)
+
+    assert resumed["success"] and resumed["totalImages"] == first["totalImages"] == 3
+    assert resumed["resumedPages"] == 2